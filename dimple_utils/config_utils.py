@@ -1,10 +1,223 @@
 import configparser
+import functools
+import hashlib
 import os
+import pickle
+import re
 import logging
+import mmap
+import sys
+from types import MappingProxyType
 
+logger = logging.getLogger(__name__)
+
+# The loaded configuration (excluding secrets) and the secrets. Deprecated for reading, use the getters or config_map.
+# They are replaced on every load, so read them through the module (config_utils.config) rather than importing them.
 config = None
 secret_config = None
 
+# Snapshots of the loaded configuration keyed by "section:key". The getters read from these plain dicts instead of
+# the ConfigParsers above.
+# The maps are updated in place on every load, so references to them (and to config_map) stay current.
+_config_map = {}
+_secret_map = {}
+
+# Read-only view of the loaded configuration (excluding secrets) for external use, keyed by "section:key"
+config_map = MappingProxyType(_config_map)
+
+# Parsed values of the typed getters keyed by (section, key). Cleared on load and on set_property, together with the
+# _resolve cache used by get_property.
+_int_cache = {}
+_float_cache = {}
+_bool_cache = {}
+
+# Environment variables with this prefix are imported even if the key is not in the properties files. The prefix is
+# stripped, e.g. DIMPLE_jira_url sets jira_url.
+ENV_PREFIX = os.environ.get("DIMPLE_ENV_PREFIX", "DIMPLE_")
+
+# One sweep over the whole file picks up section headers and key=value (or key: value) lines. Values are taken as is,
+# the same way ConfigParser reads them.
+_PROP_RE = re.compile(rb'^[ \t]*(?:\[([^\]\r\n]+)\]|([^#;=:\s\[][^=:\r\n]*?)[ \t]*[=:][ \t]*(.*?))[ \t\r]*$', re.M)
+# Non-blank, non-comment lines. If the regex did not match all of them the file uses syntax it does not cover.
+_SIGNIFICANT_RE = re.compile(rb'^[ \t]*[^#;\s]', re.M)
+# Indented lines are continuations of multi-line values in ConfigParser
+_CONTINUATION_RE = re.compile(rb'^[ \t]+[^#;\s]', re.M)
+# Optional directory where the parsed default and override files are cached, disabled unless
+# DIMPLE_CONFIG_CACHE_DIR is set. A file is parsed again when its modification time or size changes. On filesystems
+# with coarse timestamps an edit that keeps the size within the same timestamp tick can be missed, so only enable it
+# for files that don't change while the application runs. Secrets files are never cached.
+CONFIG_CACHE_DIR = os.environ.get("DIMPLE_CONFIG_CACHE_DIR") or None
+# Smaller files are read directly, mmap setup costs more than it saves for them
+_MMAP_MIN_SIZE = 4096
+
+_BOOL_MAP = {"1": True, "yes": True, "true": True, "on": True,
+             "0": False, "no": False, "false": False, "off": False}
+
+
+def _snapshot(parser: configparser.ConfigParser) -> dict:
+    """
+    Flattens the ConfigParser into a dict keyed by "section:key". Section entries include the inherited DEFAULT keys.
+    """
+    snapshot = {f"DEFAULT:{key}": value for key, value in _items(parser, parser.default_section)}
+    for section in parser.sections():
+        for key, value in _items(parser, section):
+            snapshot[f"{section}:{key}"] = value
+    return snapshot
+
+
+def _items(parser: configparser.ConfigParser, section: str) -> list:
+    """
+    Returns the interpolated items of a section. Values that can't be interpolated (e.g. a literal %) are returned
+    as they are in the file instead of failing the whole section.
+    """
+    try:
+        return parser.items(section)
+    except configparser.InterpolationError:
+        items = []
+        for key, raw_value in parser.items(section, raw=True):
+            try:
+                items.append((key, parser.get(section, key)))
+            except configparser.InterpolationError:
+                items.append((key, raw_value))
+        return items
+
+
+def _parse_properties_file(file_path: str):
+    """
+    Parses a properties file into {section: {key: value}} with a single regex sweep.
+
+    :param file_path: Path to the properties file.
+    :return: The parsed sections, or None if the file needs the full ConfigParser (multi-line values, keys outside a
+    section, duplicates, ...).
+    :raises FileNotFoundError: If the file doesn't exist.
+    """
+    with open(file_path, 'rb') as file:
+        if os.fstat(file.fileno()).st_size < _MMAP_MIN_SIZE:
+            return _parse_properties_data(file.read())
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            return _parse_properties_data(data)
+
+
+def _parse_properties_data(data):
+    """
+    Parses the raw (bytes or mmap) contents of a properties file. See _parse_properties_file.
+    """
+    if _CONTINUATION_RE.search(data):
+        return None
+
+    sections = {}
+    current = None
+    matched = 0
+    for match in _PROP_RE.finditer(data):
+        matched += 1
+        section, key, value = match.groups()
+        if section is not None:
+            section = section.decode('utf-8')
+            if section in sections:
+                return None
+            current = sections[section] = {}
+        else:
+            key = key.decode('utf-8')
+            if current is None or key in current:
+                return None
+            current[key] = value.decode('utf-8')
+
+    if matched != len(_SIGNIFICANT_RE.findall(data)):
+        return None
+    return sections
+
+
+def _load_parse_cache(cache_file: str) -> dict:
+    """
+    Loads the parsed files cached by a previous load_properties. Returns {} if there is none or it can't be read.
+    """
+    try:
+        with open(cache_file, 'rb') as file:
+            return pickle.load(file)
+    except Exception:
+        return {}
+
+
+def _save_parse_cache(cache_file: str, parse_cache: dict):
+    """
+    Writes the parse cache atomically. Failures are ignored, the cache is only an optimization.
+    """
+    try:
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        tmp_file = f"{cache_file}.{os.getpid()}.tmp"
+        with open(tmp_file, 'wb') as file:
+            pickle.dump(parse_cache, file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file, cache_file)
+    except OSError as e:
+        logger.debug("Couldn't write the properties cache %s: %s", cache_file, e)
+
+
+def _read_properties_file(config: configparser.ConfigParser, file_path: str, parse_cache: dict = None):
+    """
+    Reads a properties file into the config. Falls back to ConfigParser.read for files the fast parser doesn't handle.
+
+    :param parse_cache: Optional {path: (mtime_ns, size, sections)} of previously parsed files. Entries are reused
+    while the file is unchanged and updated otherwise.
+    :return: False if the file doesn't exist, True otherwise.
+    """
+    try:
+        if parse_cache is not None:
+            abs_path = os.path.abspath(file_path)
+            stat = os.stat(abs_path)
+            file_id = (stat.st_mtime_ns, stat.st_size)
+            cached = parse_cache.get(abs_path)
+            if cached is not None and cached[:2] == file_id:
+                sections = cached[2]
+            else:
+                sections = _parse_properties_file(file_path)
+                if sections is not None:
+                    parse_cache[abs_path] = (*file_id, sections)
+        else:
+            sections = _parse_properties_file(file_path)
+    except FileNotFoundError:
+        return False
+
+    if sections is None:
+        config.read(file_path)
+    else:
+        try:
+            config.read_dict(sections, source=file_path)
+        except ValueError:
+            # read_dict checks the interpolation syntax of every value, ConfigParser.read accepts e.g. a literal % and
+            # only fails when that value is read. Reading the whole file again overwrites what was already set with
+            # the same values.
+            config.read(file_path)
+    return True
+
+
+@functools.lru_cache(maxsize=1024)
+def _resolve(section: str, key: str):
+    return _config_map.get(f"{section}:{key.lower()}")
+
+
+def _clear_lookup_caches():
+    _resolve.cache_clear()
+    _int_cache.clear()
+    _float_cache.clear()
+    _bool_cache.clear()
+
+
+def _update_map(target: dict, snapshot: dict):
+    """
+    Replaces the contents of target with snapshot without ever emptying it, so getters running at the same time see
+    either the old or the new value of a key that is in both.
+    """
+    target.update(snapshot)
+    for key in target.keys() - snapshot.keys():
+        del target[key]
+
+
+def _publish_parsers(loaded_config: configparser.ConfigParser, loaded_secret_config: configparser.ConfigParser):
+    global config, secret_config
+    config = loaded_config
+    secret_config = loaded_secret_config
+
+
 def load_properties(default_file: str = 'default.properties', override_file: str = None, secrets_file: str = None) -> configparser.ConfigParser:
     """
     Loads global variables from default, override, and optionally a secrets file.
@@ -14,92 +227,121 @@ def load_properties(default_file: str = 'default.properties', override_file: str
     :param secrets_file: Path to the secrets properties file (optional).
     :return: Loaded configuration object (excluding secrets).
     """
-    global config, secret_config
+    # Built locally and published at the end, so the module globals never hold a half loaded configuration
     config = configparser.ConfigParser()
     secret_config = configparser.ConfigParser()
 
+    # Check if override file is passed via input or environment variable
+    if override_file is None:
+        override_file = os.getenv('OVERRIDE_FILE')
+
+    parse_cache = None
+    cache_file = None
+    if CONFIG_CACHE_DIR:
+        cache_key = hashlib.blake2b(b"|".join(os.path.abspath(p).encode() for p in (default_file, override_file or "")),
+                                    digest_size=8).hexdigest()
+        cache_file = os.path.join(CONFIG_CACHE_DIR, f"{cache_key}.pkl")
+        parse_cache = _load_parse_cache(cache_file)
+    cached_entries = dict(parse_cache) if parse_cache is not None else None
+
     # Load default properties
     try:
         print(f"Default properties file: {os.path.abspath(default_file)}")
-        config.read(default_file)
+        _read_properties_file(config, default_file, parse_cache)
         print(f"Default properties loaded from {default_file}")
-        print_properties("Before override")
+        print_properties("Before override", config)
 
     except FileNotFoundError as e:
         print(f"Default file {default_file} not found: {e}")
-        logging.error(f"Default file {default_file} not found: {e}")
+        logger.error("Default file %s not found: %s", default_file, e)
         raise
 
-    # Check if override file is passed via input or environment variable
-    if override_file is None:
-        override_file = os.getenv('OVERRIDE_FILE')
-
     # Load override properties (excluding secrets)
-    if override_file and os.path.exists(override_file):
-        config.read(override_file)
+    if override_file and _read_properties_file(config, override_file, parse_cache):
         print(f"Override properties loaded from {override_file}")
-        print_properties("After override")
+        print_properties("After override", config)
     elif override_file:
         print(f"Override file {override_file} not found. Using default properties only.")
-        logging.warning(f"Override file {override_file} not found. Using default properties only.")
+        logger.warning("Override file %s not found. Using default properties only.", override_file)
     else:
         print("No override file found. Using default properties only.")
-        logging.warning("No override file found. Using default properties only.")
+        logger.warning("No override file found. Using default properties only.")
+
+    if parse_cache is not None and parse_cache != cached_entries:
+        _save_parse_cache(cache_file, parse_cache)
 
     # Print all the configurations
     print(f"[BEGIN] Printing current configurations (before loading env and secrets):")
-    logging.info(f" [BEGIN] Printing current configurations (before loading env and secrets):")
+    logger.info(" [BEGIN] Printing current configurations (before loading env and secrets):")
     for section in config.sections():
         if section != "SECRETS":
             print(f"\nSection: {section}")
-            logging.info(f"Section={section}")
+            logger.info("Section=%s", section)
 
-            for key, value in config.items(section):
+            for key, value in _items(config, section):
                 print(f"  {key} = {value}")
-                logging.info(f"  {key} = {value}")
+                logger.info("  %s = %s", key, value)
     print(f"[DONE] Printing current configurations (before loading env and secrets).")
-    logging.info(f" [DONE] Printing current configurations (before loading env and secrets).")
+    logger.info(" [DONE] Printing current configurations (before loading env and secrets).")
 
 
-    # Let's load the environment variables. Environment variables will override the properties file
-    # Get all the environment variables
-    env_vars = os.environ
-    for key in env_vars:
-        value = env_vars[key]
+    # Let's load the environment variables. Environment variables will override the properties file.
+    # Only keys already present in the properties files, or prefixed with ENV_PREFIX, are imported
+    known_keys = set(config.defaults())
+    for section in config.sections():
+        known_keys.update(config.options(section))
+
+    env_overrides = {}
+    for env_key, value in os.environ.items():
+        # Replace _dot_ with . in the key
+        key = env_key.replace("_dot_", ".") if "_dot_" in env_key else env_key
+        if key.startswith(ENV_PREFIX):
+            key = config.optionxform(key[len(ENV_PREFIX):])
+        else:
+            key = config.optionxform(key)
+            if key not in known_keys:
+                continue
         if "$" in value:
             # With $ python gives exception
             continue
-        # Replace _dot_ with . in the key
-        key = key.replace("_dot_", ".")
-        config.set("DEFAULT", key, value)
-        print(f"Set {key} from environment variables")
+        env_overrides[key] = value
 
-    # Load secrets file (optional)
-    if secrets_file and os.path.exists(secrets_file):
-        temp_config = configparser.ConfigParser()
-        temp_config.read(secrets_file)
+    # Write straight into the DEFAULT section instead of going through ConfigParser.set for every key
+    try:
+        config._defaults.update(env_overrides)
+    except AttributeError:
+        for key, value in env_overrides.items():
+            config.set("DEFAULT", key, value)
+    logger.info("Overrode %d keys from env: %s", len(env_overrides), list(env_overrides))
 
-        # Move SECRETS section to secret_config
-        if "SECRETS" in temp_config.sections():
-            secret_config.add_section("SECRETS")
-            for key, value in temp_config.items("SECRETS"):
-                secret_config.set("SECRETS", key, value)
+    # Load secrets file (optional)
+    temp_config = configparser.ConfigParser()
+    if secrets_file and _read_properties_file(temp_config, secrets_file):
 
-        # Copy other sections to the main config (excluding SECRETS)
+        # Move SECRETS section to secret_config and copy other sections to the main config
+        secret_sections = {}
+        other_sections = {}
         for section in temp_config.sections():
-            if section != "SECRETS":
-                if not config.has_section(section):
-                    config.add_section(section)
-                for key, value in temp_config.items(section):
-                    print(f"Overriding {section}.{key} with value {value} from secrets file {secrets_file}")
-                    config.set(section, key, value)
+            target = secret_sections if section == "SECRETS" else other_sections
+            target[section] = dict(temp_config.items(section))
+        secret_config.read_dict(secret_sections, source=secrets_file)
+        config.read_dict(other_sections, source=secrets_file)
+
+        if other_sections:
+            overridden = [f"{section}.{key}" for section, items in other_sections.items() for key in items]
+            print(f"Overriding {overridden} from secrets file {secrets_file}")
 
         print(f"Secrets properties loaded from {secrets_file}")
-        logging.info(f"Secrets properties loaded from {secrets_file}")
-        print_properties("After loading secrets")
+        logger.info("Secrets properties loaded from %s", secrets_file)
+        print_properties("After loading secrets", config)
     elif secrets_file:
         print(f"Secrets file {secrets_file} not found.")
-        logging.warning(f"Secrets file {secrets_file} not found.")
+        logger.warning("Secrets file %s not found.", secrets_file)
+
+    _update_map(_config_map, _snapshot(config))
+    _update_map(_secret_map, _snapshot(secret_config))
+    _clear_lookup_caches()
+    _publish_parsers(config, secret_config)
 
     return config
 
@@ -111,56 +353,72 @@ def get_secret(key: str, section: str = "SECRETS") -> str:
     :param section: The section in the secret_config. Default is "SECRETS".
     :return: The secret value or None if not found.
     """
-    if secret_config.has_option(section, key):
-        return secret_config.get(section, key)
+    value = _secret_map.get(f"{section}:{key.lower()}")
+    if value is not None:
+        return value
     else:
-        logging.warning(f"Secret key '{key}' not found in section '{section}'.")
+        logger.warning("Secret key '%s' not found in section '%s'.", key, section)
         return None
 
-def print_properties(debug_string: str):
+def print_properties(debug_string: str, config: configparser.ConfigParser = None):
     """
     Prints only the keys of properties explicitly defined in each section.
     :param debug_string: A string to differentiate the output (e.g., "Before override", "After override")
+    :param config: The ConfigParser being loaded. Defaults to the loaded configuration.
     """
-    print(f"\n--- {debug_string} ---")
-    logging.info(f"--- {debug_string} ---")
+    # Skip building the dump entirely unless debug logging is on
+    if not logger.isEnabledFor(logging.DEBUG):
+        return
 
-    # Print keys in the DEFAULT section
-    if config.defaults():
-        print("Keys in DEFAULT section:")
-        for key in config.defaults():
-            print(f"  {key}")
+    if config is not None:
+        defaults = config.defaults()
+        section_items = {section: _items(config, section) for section in config.sections()}
+    else:
+        defaults = {}
+        section_items = {}
+        for name, value in _config_map.items():
+            section, _, key = name.partition(":")
+            if section == "DEFAULT":
+                defaults[key] = value
+            else:
+                section_items.setdefault(section, []).append((key, value))
 
-        logging.info(f"Keys in DEFAULT section: {list(config.defaults().keys())}")
+    lines = [f"\n--- {debug_string} ---"]
 
-    # Print keys in each section, excluding keys inherited from DEFAULT
-    for section in config.sections():
-        print(f"Explicit keys in section '{section}':")
-        section_keys = config.options(section)
-        default_keys = config.defaults().keys()
+    # Print keys in the DEFAULT section
+    default_keys = frozenset(defaults)
+    if defaults:
+        lines.append("Keys in DEFAULT section:")
+        lines.extend(f"  {key}" for key in defaults)
 
+    # Print keys in each section, excluding keys inherited from DEFAULT
+    for section, items in section_items.items():
+        lines.append(f"Explicit keys in section '{section}':")
         # Filter out the keys that are present in DEFAULT
-        explicit_keys = [key for key in section_keys if key not in default_keys]
+        lines.extend(f"  {key}" for key, _ in items if key not in default_keys)
 
-        for key in explicit_keys:
-            print(f"  {key}")
-        logging.info(f"Explicit keys in section '{section}': {explicit_keys}")
+    # Only the keys go to stdout, the values are logged
+    output = "\n".join(lines)
+    sys.stdout.write(output + "\n")
 
-    for section in config.sections():
+    for section, items in section_items.items():
         if section != "SECRETS":
-            for key, value in config.items(section):
-                logging.info(f"[{section}].{key}={value}")
+            lines.extend(f"[{section}].{key}={value}" for key, value in items)
+    logger.debug("%s", "\n".join(lines))
 
 
 def set_property(key: str, value: str, section: str = 'DEFAULT'):
     """
-    Set a property value in the configuration object.
+    Set a property value in the configuration object. The value is set on the loaded ConfigParser and the snapshot
+    is rebuilt from it, so interpolation, DEFAULT inheritance and the value checks work the same as ConfigParser.set.
     :param key:
     :param value:
     :param section:
     :return:
     """
     config.set(section, key, value)
+    _update_map(_config_map, _snapshot(config))
+    _clear_lookup_caches()
 
 def get_property(key: str, section: str = 'DEFAULT', fallback: any = None) -> str:
     """
@@ -171,7 +429,8 @@ def get_property(key: str, section: str = 'DEFAULT', fallback: any = None) -> st
     :param fallback: Fallback value if the property is not found.
     :return: The property value as a string or fallback.
     """
-    return config.get(section, key, fallback=fallback)
+    value = _resolve(section, key)
+    return fallback if value is None else value
 
 def get_int_property(key: str, section: str = 'DEFAULT', fallback: int = 0) -> int:
     """
@@ -182,7 +441,19 @@ def get_int_property(key: str, section: str = 'DEFAULT', fallback: int = 0) -> i
     :param fallback: Fallback value if the property is not found.
     :return: The property value as an integer or fallback.
     """
-    return config.getint(section, key, fallback=fallback)
+    key = key.lower()
+    cached = _int_cache.get((section, key))
+    if cached is not None:
+        return cached
+    value = _config_map.get(f"{section}:{key}")
+    if value is None:
+        return fallback
+    try:
+        cached = _int_cache[(section, key)] = int(value)
+    except ValueError:
+        logger.error("Property '%s' in section '%s' is not an integer: %s", key, section, value)
+        raise
+    return cached
 
 def get_bool_property(key: str, section: str = 'DEFAULT', fallback: bool = False) -> bool:
     """
@@ -193,7 +464,18 @@ def get_bool_property(key: str, section: str = 'DEFAULT', fallback: bool = False
     :param fallback: Fallback value if the property is not found.
     :return: The property value as a boolean or fallback.
     """
-    return config.getboolean(section, key, fallback=fallback)
+    key = key.lower()
+    cached = _bool_cache.get((section, key))
+    if cached is not None:
+        return cached
+    value = _config_map.get(f"{section}:{key}")
+    if value is None:
+        return fallback
+    cached = _BOOL_MAP.get(value.lower())
+    if cached is None:
+        raise ValueError(f"Not a boolean: {value}")
+    _bool_cache[(section, key)] = cached
+    return cached
 
 def get_float_property(key: str, section: str = 'DEFAULT', fallback: float = 0.0) -> float:
     """
@@ -204,4 +486,16 @@ def get_float_property(key: str, section: str = 'DEFAULT', fallback: float = 0.0
     :param fallback: Fallback value if the property is not found.
     :return: The property value as a float or fallback.
     """
-    return config.getfloat(section, key, fallback=fallback)
+    key = key.lower()
+    cached = _float_cache.get((section, key))
+    if cached is not None:
+        return cached
+    value = _config_map.get(f"{section}:{key}")
+    if value is None:
+        return fallback
+    try:
+        cached = _float_cache[(section, key)] = float(value)
+    except ValueError:
+        logger.error("Property '%s' in section '%s' is not a float: %s", key, section, value)
+        raise
+    return cached
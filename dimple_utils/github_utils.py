@@ -1,27 +1,44 @@
+import functools
 import logging
 
 from dimple_utils import config_utils
 #pip install PyGithub
 from github import Github
 
-github = None
+logger = logging.getLogger(__name__)
 
-def setup_github():
-    global github
 
+@functools.lru_cache(maxsize=None)
+def _get_client():
     """
-    Setup the GitHub client with the required credentials.
+    Creates the GitHub client with the required credentials on first use.
     """
     # Load the GitHub credentials from the configuration
     github_user = config_utils.get_property("github_user")
     github_token = config_utils.get_secret("github_token")
 
-    logging.info(f"Setting up GitHub client for user: {github_user}")
+    logger.info("Setting up GitHub client for user: %s", github_user)
     # Initialize the GitHub client
-    github = Github(github_user, github_token)
+    return Github(github_user, github_token)
+
+def setup_github():
+    """
+    Setup the GitHub client with the required credentials. Calling this is optional, the client is created on first
+    use. Calling it again picks up changed credentials.
+    """
+    reset_clients()
+    _get_client()
+
+def reset_clients():
+    """
+    Drops the cached client and repositories, e.g. between tests.
+    """
+    get_repo.cache_clear()
+    _get_client.cache_clear()
 
+@functools.lru_cache(maxsize=128)
 def get_repo(repo_name):
-    return github.get_repo(repo_name)
+    return _get_client().get_repo(repo_name)
 
 def get_issues(repo_name):
     repo = get_repo(repo_name)
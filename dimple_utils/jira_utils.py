@@ -1,10 +1,20 @@
 import base64
+import functools
+import itertools
 import logging
+import operator
 import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
-from jira import JIRA
+from jira import JIRA, Issue
 import requests
+from requests.adapters import HTTPAdapter
+from requests.auth import HTTPBasicAuth
+from urllib3.util.retry import Retry
 import json
 
 # Import the config_utils from the dimple_utils package
@@ -17,24 +27,72 @@ board_url = None
 
 # Constants
 sprint_custom_field = 'customfield_10020'
+_sprint_getter = operator.attrgetter(sprint_custom_field)
 jira_http_request_headers = None
+JSON_HEADERS = {
+    "Content-Type": "application/json",
+    "Accept": "application/json"
+}
+_http_session = None
 JIRA_URL = None
 done_status_list = ('Done', 'Resolved', 'Closed', 'Verified', 'Invalid')
-done_status_list_str = "('Done', 'Resolved', 'Closed', 'Verified', 'Invalid')"
-JIRA_PM_LABELS = ("pm-high", "pm-medium", "pm-low", "pm-neutral")
+# For membership checks in Python, and the JQL form of the list, e.g. "status in ('Done', ...)"
+done_status_set = frozenset(done_status_list)
+done_status_list_str = "(" + ", ".join(f"'{status}'" for status in done_status_list) + ")"
+# Maximum number of JIRA requests sent in parallel for independent updates (e.g. links and sub-tasks when cloning)
+max_concurrent_requests = 6
+# Number of clones clone_jiras updates at the same time. Each clone sends its own updates in parallel, so this is kept
+# lower than max_concurrent_requests
+max_concurrent_clones = 4
+# Maximum number of issues JIRA accepts in one rank request
+RANK_BATCH_SIZE = 50
+# Number of input lines apply_pm_labels processes at a time
+LABEL_BATCH_SIZE = 50
+JIRA_PM_LABELS = frozenset(("pm-high", "pm-medium", "pm-low", "pm-neutral"))
 email_to_user_id_map = {}
+_BOARD_ID_RE = re.compile(r'boards/(\d+)')
+# Board ID parsed from board_url, see get_board_id. Cleared by set_board_url
+_board_id_cache = {}
+# Smart quotes pasted into JQL are replaced with plain ones
+_SMART_QUOTE_TABLE = str.maketrans({"‘": "'", "’": "'"})
+# Fields fetched by get_story_and_sub_tasks, enough for prepare_issue_for_cloning
+CLONE_ISSUE_FIELDS = ("project,summary,description,status,labels,components,issuetype,reporter,assignee,issuelinks,"
+                      f"{sprint_custom_field}")
+# Fields prepare_issue_for_cloning reads directly from the parent. The sprint is optional, see get_sprint
+_CLONE_REQUIRED_FIELDS = ("project", "summary", "description", "components", "issuetype", "reporter", "assignee",
+                          "issuelinks")
+SUB_TASK_FIELDS = "summary,status,assignee,issuetype,parent"
+# Page size for issue searches that fetch all results (property jira_search_batch_size). The library default is 100
+# per request. Only Jira Server/Data Center honours it: on Jira Cloud, jira>=3.9 uses the enhanced search, whose page
+# size is fixed at 100 by the library, so this setting has no effect there
+search_batch_size = 500
+# Maximum number of issues cached by issue(), see there. 0 disables the cache
+issue_cache_max_items = 0
+_issue_cache = OrderedDict()
+_issue_cache_lock = threading.Lock()
+# Active sprints per board_id as (expires_at, sprints). The active sprint changes every few weeks at most
+ACTIVE_SPRINT_TTL_SECONDS = 300
+_active_sprint_cache = {}
 
 def setup_jira():
     """
     Sets up the JIRA connection and configuration using values from config_utils.
     """
-    global jira, jira_http_request_headers, JIRA_URL
+    global jira, jira_http_request_headers, JIRA_URL, _http_session, max_concurrent_requests, issue_cache_max_items, \
+        search_batch_size
 
     # JIRA Configuration from config_utils
 
     JIRA_URL = config_utils.get_property('jira_url')
     JIRA_USER = config_utils.get_property('jira_user')
     JIRA_TOKEN = config_utils.get_secret("jira_token")
+    max_concurrent_requests = config_utils.get_int_property('jira_max_concurrent_requests',
+                                                            fallback=max_concurrent_requests)
+    issue_cache_max_items = config_utils.get_int_property('jira_cache_max_items', fallback=issue_cache_max_items)
+    search_batch_size = config_utils.get_int_property('jira_search_batch_size', fallback=search_batch_size)
+    with _issue_cache_lock:
+        _issue_cache.clear()
+    invalidate_active_sprint()
 
     JIRA_URL = JIRA_URL.strip() if JIRA_URL else None
     JIRA_USER = JIRA_USER.strip() if JIRA_USER else None
@@ -50,18 +108,38 @@ def setup_jira():
         raise Exception("jira_token property is not configured")
 
 
+    jira = JIRA(server=JIRA_URL, basic_auth=(JIRA_USER, JIRA_TOKEN), validate=True,
+                default_batch_sizes={Issue: search_batch_size})
+    # The parallel calls go through the JIRA client's own session, whose pool holds 10 connections by default. Each of
+    # the max_concurrent_clones clones can send max_concurrent_requests requests at once. The client retries on its
+    # own, so no retries are added here. The jira library has no option for the pool size, the session is a private
+    # attribute of the client, so it is only resized if it is there.
+    jira_session = getattr(jira, "_session", None)
+    if hasattr(jira_session, "mount"):
+        jira_session.mount(JIRA_URL, HTTPAdapter(pool_connections=4,
+                                                 pool_maxsize=max_concurrent_clones * max_concurrent_requests))
+    else:
+        logger.warning("Can't resize the connection pool of the JIRA client, parallel requests may wait for a "
+                       "connection.")
+
+    # Shared session for the raw REST calls, so connections to JIRA are kept alive and reused. Authentication is done
+    # by the session, so the credentials are encoded in one place only.
+    http_auth = HTTPBasicAuth(JIRA_USER, JIRA_TOKEN)
+    _http_session = requests.Session()
+    _http_session.auth = http_auth
+    retry = Retry(total=3, backoff_factor=0.3, status_forcelist=(429, 500, 502, 503, 504),
+                  allowed_methods=frozenset(["PUT", "GET", "POST"]))
+    # Mounted on the JIRA URL itself, so an http:// server gets the pool and the retries too. The pool is at least as
+    # big as the number of parallel requests, otherwise connections get dropped instead of reused.
+    _http_session.mount(JIRA_URL, HTTPAdapter(pool_connections=4, pool_maxsize=max(16, max_concurrent_requests),
+                                              max_retries=retry))
+    _http_session.headers.update(JSON_HEADERS)
+
+    # Full HTTP request headers for callers that don't use the session
     base64_credentials = base64.b64encode(f"{JIRA_USER}:{JIRA_TOKEN}".encode()).decode()
-    jira = JIRA(server=JIRA_URL, basic_auth=(JIRA_USER, JIRA_TOKEN), validate=True)
-
-
-    # Setup HTTP request headers
-    jira_http_request_headers = {
-        'Authorization': f"Basic {base64_credentials}",
-        'Content-Type': 'application/json',
-        "Accept": "application/json"
-    }
+    jira_http_request_headers = {'Authorization': f"Basic {base64_credentials}", **JSON_HEADERS}
 
-    logger.info(f"JIRA connection setup completed. JIRA_URL={JIRA_URL}, JIRA_USER={JIRA_USER}")
+    logger.info("JIRA connection setup completed. JIRA_URL=%s, JIRA_USER=%s", JIRA_URL, JIRA_USER)
 
 
 def get_jira_http_request_headers():
@@ -72,6 +150,35 @@ def get_jira_http_request_headers():
     return jira_http_request_headers
 
 
+def get_jira_http_session():
+    """
+    Returns the requests session used for the raw JIRA REST calls. The JIRA credentials and JSON headers are already
+    set on it.
+    """
+    global _http_session
+    return _http_session
+
+
+def run_in_parallel(calls, max_workers=None, return_exceptions=False):
+    """
+    Runs independent JIRA calls in parallel and returns their results in the same order.
+
+    :param calls: List of callables that take no arguments.
+    :param max_workers: Maximum number of parallel calls. Defaults to max_concurrent_requests.
+    :param return_exceptions: If True, a failed call's exception is returned in its place in the results.
+    :return: The list of results. Unless return_exceptions is set, if any call fails the first exception (in call
+    order) is raised after all calls have finished.
+    """
+    if not calls:
+        return []
+    max_workers = max_workers or max_concurrent_requests
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(calls))) as executor:
+        futures = [executor.submit(call) for call in calls]
+    if not return_exceptions:
+        return [future.result() for future in futures]
+    return [future.exception() or future.result() for future in futures]
+
+
 def parse_sprint_field(issue, sprint):
 
     # Assuming the sprint field is a string that needs to be parsed
@@ -82,35 +189,24 @@ def parse_sprint_field(issue, sprint):
         #print(f"issue={issue.key} sprint_name={sprint_name}, sprint_state={sprint_state}")
         return (sprint_name, sprint_state)
     except Exception as ex:
-        print(ex)
+        logger.warning("Error parsing sprint field for issue %s ex=%s", issue.key, ex)
         return None
 
 def get_sprint(issue):
-
     try:
-        if hasattr(issue.fields, sprint_custom_field):
-            sprint_field = getattr(issue.fields, sprint_custom_field)
-            if isinstance(sprint_field, list):
-                return sprint_field[0]
-            else:
-                return sprint_field
-        else:
-            return None
-    except AttributeError as ex:
-        print(f"Error getting sprint field for issue {issue.key} ex={ex}")
+        sprint_field = _sprint_getter(issue.fields)
+    except AttributeError:
         return None
 
+    if isinstance(sprint_field, list):
+        return sprint_field[0] if sprint_field else None
+    return sprint_field
+
 
 def get_relevant_sprint(issue):
     try:
-        if hasattr(issue.fields, sprint_custom_field):
-            sprint_field = getattr(issue.fields, sprint_custom_field)
-            #print(f"GOT SPRINT FIELD {sprint_field}")
-        else:
-            #print(f"NO SPRINT FIELD")
-            return None
-    except AttributeError as ex:
-        print(f"Error getting sprint field for issue {issue.key} ex={ex}")
+        sprint_field = _sprint_getter(issue.fields)
+    except AttributeError:
         return None
 
     if not sprint_field:
@@ -119,96 +215,112 @@ def get_relevant_sprint(issue):
     if not isinstance(sprint_field, list):
         sprint_field = [sprint_field]
 
-
-    #print(sprint_field)
-    active_sprint = None
-    future_sprint = None
-
-    # Iterate through the Sprints and categorize them
-    for sprint in sprint_field:
-        # print(f"sprint={sprint}")
-        (sprint_name, sprint_state) = parse_sprint_field(issue, sprint)
-        if sprint_state == 'active':
-            active_sprint = sprint_name
-        elif sprint_state == 'future':
-            future_sprint = sprint_name
-
     # Prioritize active Sprint, fallback to future Sprint
-    return active_sprint if active_sprint else future_sprint
+    active_sprint = next((sprint.name for sprint in sprint_field if sprint.state == 'active'), None)
+    if active_sprint:
+        return active_sprint
+    return next((sprint.name for sprint in sprint_field if sprint.state == 'future'), None)
 
-def fetch_issues(jira_project, num_issues=None, jql_query=None):
+def fetch_issues(jira_project, num_issues=None, jql_query=None, fields=None):
+    """
+    Searches the issues of a project in rank order.
+
+    :param jira_project: The project key.
+    :param num_issues: Maximum number of issues to return. All issues if not set, which makes the jira library page
+    through the results search_batch_size issues at a time (100 at a time on Jira Cloud, see search_batch_size). Set
+    it when an upper bound is known to get a single page.
+    :param jql_query: Optional JQL to AND with the project filter.
+    :param fields: Optional fields to fetch, as a comma separated string or a list of field names. All navigable
+    fields if not set, pass only the fields you need to keep the responses small.
+    """
     global jira
-    logger.info(f"Fetching issues for project {jira_project} with jql_query={jql_query} ...")
+    logger.info("Fetching issues for project %s with jql_query=%s ...", jira_project, jql_query)
     max_results = num_issues if num_issues else False
 
     # Establishing connection with JIRA
     user_jql = ""
     if jql_query:
-        jql_query = jql_query.replace("‘", "'")
-        jql_query = jql_query.replace("’", "'")
+        jql_query = jql_query.translate(_SMART_QUOTE_TABLE)
         user_jql = f"and {jql_query}"
 
     consolidated_jql_query = f"project={jira_project} {user_jql}".strip() + " ORDER BY RANK ASC"
+    if fields is not None and not isinstance(fields, str):
+        fields = ",".join(fields)
 
-    logger.info(f"consolidated_jql_query={consolidated_jql_query}")
-    issues = jira.search_issues(consolidated_jql_query, maxResults=max_results)
+    logger.info("consolidated_jql_query=%s", consolidated_jql_query)
+    issues = jira.search_issues(consolidated_jql_query, maxResults=max_results, fields=fields)
 
     return issues
 
 
 def rank_issue(issue, after_issue):
-    logger.info(f"Attempting to rank issue {issue} after {after_issue}")
+    return rank_issues([issue], after_issue)
+
+def rank_issues(issues, after_issue):
+    """
+    Ranks the issues, in the given order, right after after_issue with a single request.
+
+    :param issues: The issue keys to rank. JIRA accepts at most RANK_BATCH_SIZE issues per request.
+    :param after_issue: The issue key to rank them after.
+    """
+    logger.info("Attempting to rank issues %s after %s", issues, after_issue)
     url = f"{JIRA_URL}/rest/agile/1.0/issue/rank"
     payload = json.dumps({
         "rankAfterIssue": after_issue,
-        "issues": [issue]
+        "issues": list(issues)
     })
 
-    response = requests.request(
-        "PUT",
-        url,
-        data=payload,
-        headers=get_jira_http_request_headers()
-    )
-    logger.info(f"ur={url}, response={response}")
+    response = get_jira_http_session().put(url, data=payload)
+    logger.info("ur=%s, response=%s", url, response)
     if response.status_code == 204:
-        logger.info(f"Successfully ranked issue {issue} before {after_issue}.")
+        logger.info("Successfully ranked issues %s after %s.", issues, after_issue)
         return True
     else:
+        # 207 means some of the issues in the batch were not ranked
         raise Exception(f"Failed to rank issue. Status code: {response.status_code}, Response: {response.text}")
         # logger.error(f"Failed to rank issue. Status code: {response.status_code}, Response: {response.text}")
         # return False
 
+def _issue_keys(input_text):
+    """
+    Yields the issue key (first comma separated column) of each non-empty line. splitlines() handles \n, \r\n and
+    trailing newlines.
+    """
+    for line in input_text.splitlines():
+        key = line.partition(',')[0].strip()
+        if key:  # Skip empty lines
+            yield key
+
+
+def _batches(iterable, batch_size):
+    iterator = iter(iterable)
+    return iter(lambda: list(itertools.islice(iterator, batch_size)), [])
+
+
 def reorder_issues_from_multiline(input_text):
-    lines = input_text.split('\n')
-    previous_issue_key = None
+    issue_keys = _issue_keys(input_text)
+    previous_issue_key = next(issue_keys, None)
+    if previous_issue_key is None:
+        current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")  # Format the timestamp
+        return "warning", f"No issues reordered. Please provide the list of JIRAs to be reordered. Attempted at {current_time}"
 
-    #print(f"lines={lines}")
-    logger.info(f"lines={lines}")
+    # Each batch is ranked after the last issue of the previous batch. The batches have to go in order, ranking a
+    # batch after an issue that hasn't been moved yet would put it in the wrong place.
     reordered_count = 0
-    for line in lines:
-        line = line.strip()  # Remove leading and trailing whitespace
-        if not line:  # Skip empty lines
-            continue
-        if not previous_issue_key:
-            previous_issue_key = line.split(',')[0].strip()
-            #print(f"Setting previous_issue_key={previous_issue_key}")
-            continue
-        print(f"line={line}")
-        current_issue_key = line.split(',')[0].strip()
-
-        if previous_issue_key:
-            try:
-                rank_issue(current_issue_key, previous_issue_key)
-                reordered_count += 1
-                print(f"Successfully ranked {current_issue_key} after {previous_issue_key} reordered_count={reordered_count}")
-            except Exception as e:
-                current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")  # Format the timestamp
-                status_message = (f"An error occurred while ranking {current_issue_key} after {previous_issue_key}: "
-                                  f"{e}. Attempted at {current_time}.")
-                return "error", status_message
-            previous_issue_key = current_issue_key
-
+    for batch in _batches(issue_keys, RANK_BATCH_SIZE):
+        try:
+            rank_issues(batch, previous_issue_key)
+            reordered_count += len(batch)
+            logger.debug("Successfully ranked %s after %s reordered_count=%s", batch, previous_issue_key,
+                         reordered_count)
+        except Exception as e:
+            current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")  # Format the timestamp
+            status_message = (f"An error occurred while ranking {batch} after {previous_issue_key}: "
+                              f"{e}. Attempted at {current_time}.")
+            return "error", status_message
+        previous_issue_key = batch[-1]
+
+    logger.info("reorder_issues_from_multiline: ranked %d issues after %s", reordered_count, previous_issue_key)
     current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")  # Format the timestamp
 
     if not reordered_count:
@@ -217,44 +329,70 @@ def reorder_issues_from_multiline(input_text):
     return "success", f"Successfully reordered {reordered_count} issues. Attempted at {current_time}"
 
 
-def apply_pm_labels(pm_label, input_text):
-    lines = input_text.split('\n')
-    previous_issue_key = None
+def _update_labels(jira_issue, labels):
+    try:
+        jira_issue.update(fields={"labels": labels})
+    finally:
+        invalidate_issue(jira_issue)
+
+
+def _fetch_labels(issue_keys):
+    """
+    Fetches the labels of the issues with one search instead of one GET per issue. Returns a dict of issue key to
+    issue. Keys the search doesn't return as-is (e.g. issues moved to another project) are fetched one by one. The
+    query isn't validated, so an unknown key is skipped by the search instead of failing it for all the others.
+    """
+    key_list = ", ".join(f'"{key}"' for key in issue_keys)
+    issues_by_key = {jira_issue.key: jira_issue
+                     for jira_issue in jira.search_issues(f"key in ({key_list})", fields="labels",
+                                                          maxResults=len(issue_keys), validate_query=False)}
+    for key in issue_keys:
+        if key not in issues_by_key:
+            issues_by_key[key] = issue(key, fields="labels")
+    return issues_by_key
 
-    #print(f"lines={lines}")
-    logger.info(f"lines={lines}")
+
+def apply_pm_labels(pm_label, input_text):
     applied_count = 0
     ignored_count = 0
-    for line in lines:
-        line = line.strip()  # Remove leading and trailing whitespace
-        if not line:  # Skip empty lines
-            continue
-        current_issue_key = line.split(',')[0].strip()
-        jira_issue = issue(current_issue_key)
-        current_labels = jira_issue.fields.labels
-        pm_labels = [label for label in current_labels if label in JIRA_PM_LABELS]
-        if pm_label not in current_labels or (pm_labels and len(pm_labels) > 1):
-            # Check if any of the PM labels are already there
-            pm_labels = [label for label in current_labels if label in JIRA_PM_LABELS]
-            if pm_labels:
-                for current_label in pm_labels:
-                    logger.info(f"Removing label {current_label} from issue {current_issue_key}...")
-                    current_labels.remove(current_label)
-                # current_labels.remove(pm_labels[0])
-            current_labels.append(pm_label)
-            logger.info(f"Applying label {pm_label} to issue {current_issue_key}...")
-            try:
-                jira_issue.update(fields={"labels": current_labels})
-            except Exception as e:
-                current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                status_message = (f"An error occurred while applying label {pm_label} to issue {current_issue_key}: "
-                                  f"{e}. Attempted at {current_time}. Successfully applied {applied_count} labels."
-                                  f"Ignored {ignored_count} labels.")
-                return "error", status_message
-            applied_count += 1
-        else:
-            logger.info(f"Issue {current_issue_key} already has the label {pm_label}. Ignoring...")
-            ignored_count += 1
+    # Work through the input in batches, so large inputs are streamed and progress is logged as we go
+    for batch in _batches(_issue_keys(input_text), LABEL_BATCH_SIZE):
+        updates = []
+        unique_keys = list(dict.fromkeys(batch))
+        # A key listed again is labeled once, the repeats count as ignored
+        ignored_count += len(batch) - len(unique_keys)
+        issues_by_key = _fetch_labels(unique_keys)
+        for current_issue_key in unique_keys:
+            jira_issue = issues_by_key[current_issue_key]
+            current_labels = jira_issue.fields.labels
+            current_label_set = frozenset(current_labels)
+            target_label_set = (current_label_set - JIRA_PM_LABELS) | {pm_label}
+            if current_label_set == target_label_set:
+                logger.info("Issue %s already has the label %s. Ignoring...", current_issue_key, pm_label)
+                ignored_count += 1
+                continue
+
+            # Replace any PM labels already there with the new one
+            for current_label in current_label_set - target_label_set:
+                logger.info("Removing label %s from issue %s...", current_label, current_issue_key)
+            new_labels = [label for label in current_labels if label not in JIRA_PM_LABELS and label != pm_label]
+            new_labels.append(pm_label)
+            logger.info("Applying label %s to issue %s...", pm_label, current_issue_key)
+            updates.append((current_issue_key, jira_issue, new_labels))
+
+        # The label updates are independent, send them in parallel
+        results = run_in_parallel([functools.partial(_update_labels, jira_issue, labels)
+                                   for _, jira_issue, labels in updates], return_exceptions=True)
+        errors = [(key, result) for (key, _, _), result in zip(updates, results) if isinstance(result, Exception)]
+        applied_count += len(updates) - len(errors)
+        logger.info("Applied %s to %s issues so far. Ignored %s.", pm_label, applied_count, ignored_count)
+        if errors:
+            current_issue_key, e = errors[0]
+            current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            status_message = (f"An error occurred while applying label {pm_label} to issue {current_issue_key}: "
+                              f"{e}. Attempted at {current_time}. Successfully applied {applied_count} labels."
+                              f"Ignored {ignored_count} labels. Failed {len(errors)} labels.")
+            return "error", status_message
 
 
     stat_message = f"Successfully applied {applied_count} labels. Ignored {ignored_count} labels."
@@ -267,16 +405,17 @@ def apply_pm_labels(pm_label, input_text):
 
 def create_issue(fields):
     global jira
-    logging.info(f"Creating issue with fields={fields}")
+    logger.info("Creating issue with fields=%s", fields)
     return jira.create_issue(fields=fields)
 
 
 def update_issue( jira_issue, fields ):
-    logging.info(f"Updating issue {jira_issue.key} with fields={fields}")
+    logger.info("Updating issue %s with fields=%s", jira_issue.key, fields)
     jira_issue.update(fields)
+    invalidate_issue(jira_issue)
 
 def close_issue( jira_issue, comment=None ):
-    logging.info(f"Closing issue {jira_issue.key} with comment={comment}")
+    logger.info("Closing issue %s with comment=%s", jira_issue.key, comment)
 
     if comment:
         add_comment(jira_issue.key, comment)
@@ -286,62 +425,122 @@ def close_issue( jira_issue, comment=None ):
     for transition in transitions:
         if transition['name'].lower() == 'done':
             transistion_close_id = transition['id']
-            logging.info(f"Transition ID for Done status found for issue {jira_issue.key}.")
+            logger.info("Transition ID for Done status found for issue %s.", jira_issue.key)
             break
 
     if not transistion_close_id:
-        logger.error(f"Transition ID for Done status not found for issue {jira_issue.key}. Available transitions: "
-                     f"{transitions}")
+        logger.error("Transition ID for Done status not found for issue %s. Available transitions: %s", jira_issue.key,
+                     transitions)
     else:
         jira.transition_issue(jira_issue, transistion_close_id)
+        invalidate_issue(jira_issue)
 
 def delete_issue( jira_issue ):
-    logging.info(f"Deleting issue {jira_issue.key}")
+    logger.info("Deleting issue %s", jira_issue.key)
     jira.delete_issue(jira_issue)
+    invalidate_issue(jira_issue)
 
 def create_issue_link(type, inwardIssue, outwardIssue):
     global jira
-    logger.info(f"Creating issue link type={type} inwardIssue={inwardIssue} outwardIssue={outwardIssue}")
+    logger.info("Creating issue link type=%s inwardIssue=%s outwardIssue=%s", type, inwardIssue, outwardIssue)
     return jira.create_issue_link(type=type, inwardIssue=inwardIssue, outwardIssue=outwardIssue)
 
 
 def add_comment(key, comment_text):
     global jira
-    logger.info(f"Adding comment to issue {key} comment={comment_text}...")
-    return jira.add_comment(key, comment_text)
+    logger.info("Adding comment to issue %s comment=%s...", key, comment_text)
+    result = jira.add_comment(key, comment_text)
+    invalidate_issue(key)
+    return result
 
 
-def issue(key):
+def issue(key, fields=None):
+    """
+    Fetches an issue. If issue_cache_max_items (property jira_cache_max_items) is set, issues are cached per
+    (key, fields) up to that many entries, the least recently used are dropped first. Cached issues don't expire: the
+    update functions in this module invalidate the issues they change, call invalidate_issue() after changing an issue
+    by other means. Only enable it when issues aren't changed outside the application while it runs.
+
+    :param key: The issue key.
+    :param fields: Optional comma separated list of fields to fetch.
+    """
     global jira
-    logger.info(f"Fetching issue {key}...")
-    return jira.issue(key)
+    if issue_cache_max_items <= 0:
+        logger.info("Fetching issue %s...", key)
+        return jira.issue(key) if fields is None else jira.issue(key, fields=fields)
+
+    cache_key = (key, fields)
+    with _issue_cache_lock:
+        cached = _issue_cache.get(cache_key)
+        if cached is not None:
+            _issue_cache.move_to_end(cache_key)
+            return cached
+
+    logger.info("Fetching issue %s...", key)
+    jira_issue = jira.issue(key) if fields is None else jira.issue(key, fields=fields)
+    with _issue_cache_lock:
+        _issue_cache[cache_key] = jira_issue
+        while len(_issue_cache) > issue_cache_max_items:
+            _issue_cache.popitem(last=False)
+    return jira_issue
+
+def invalidate_issue(key_or_issue):
+    """
+    Drops an issue from the cache used by issue().
+
+    :param key_or_issue: The issue key or the issue.
+    """
+    key = getattr(key_or_issue, "key", key_or_issue)
+    with _issue_cache_lock:
+        for cache_key in [cache_key for cache_key in _issue_cache if cache_key[0] == key]:
+            del _issue_cache[cache_key]
 
-def get_issues_by_field( jira_project, field_name, field_value):
+def get_issues_by_field( jira_project, field_name, field_value, fields=None):
+    """
+    Fetches the issues of a project where field_name is field_value.
+
+    :param fields: Optional fields to fetch, see fetch_issues. All navigable fields if not set.
+    """
     global jira
     jql_query = f"{field_name}='{field_value}'"
-    logger.info(f"Fetching issues for field_name={field_name} field_value={field_value} jql_query={jql_query} ...")
-    return fetch_issues(jira_project, jql_query=jql_query)
+    logger.info("Fetching issues for field_name=%s field_value=%s jql_query=%s ...", field_name, field_value, jql_query)
+    return fetch_issues(jira_project, jql_query=jql_query, fields=fields)
 
 def transition_issue(task, fields):
     global jira
-    logger.info(f"Transitioning issue {task} with fields={fields}...")
-    return jira.transition_issue(task, fields=fields)
+    logger.info("Transitioning issue %s with fields=%s...", task, fields)
+    result = jira.transition_issue(task, fields=fields)
+    invalidate_issue(task)
+    return result
 
 
 def get_story_and_sub_tasks(jira_key):
+    """
+    Fetches a story with the fields needed to clone it (CLONE_ISSUE_FIELDS) and its sub-tasks with
+    SUB_TASK_FIELDS. All the sub-tasks are fetched, the jira library pages through them. Don't cap the search with
+    num_issues: Jira Cloud doesn't report the total, so a truncated page can't be detected and the remaining sub-tasks
+    would stay on the old parent when cloning.
+    """
     story_and_sub_tasks = {"parent": None, "sub_tasks": [] }
-    parent = jira.issue(jira_key)
+    parent = jira.issue(jira_key, fields=CLONE_ISSUE_FIELDS)
     if parent:
         story_and_sub_tasks["parent"] = parent
         jql_query = f"parent={jira_key}"
-        story_and_sub_tasks["sub_tasks"] = fetch_issues(parent.fields.project.key, jql_query=jql_query)
+        story_and_sub_tasks["sub_tasks"] = fetch_issues(parent.fields.project.key, jql_query=jql_query,
+                                                        fields=SUB_TASK_FIELDS)
     else:
-        logger.error(f"Parent issue {jira_key} not found.")
+        logger.error("Parent issue %s not found.", jira_key)
 
     return story_and_sub_tasks
 
 
 def prepare_issue_for_cloning(parent, new_summary, sub_tasks):
+    # A parent loaded with a reduced field set (e.g. issue(key, fields="labels")) is fetched again, once, with all the
+    # fields needed here
+    if not all(hasattr(parent.fields, field) for field in _CLONE_REQUIRED_FIELDS):
+        logger.info("Fetching the clone fields for %s", parent.key)
+        parent = jira.issue(parent.key, fields=CLONE_ISSUE_FIELDS)
+
     components_for_clone = [{'name': component.name} for component in parent.fields.components]
     sprint = get_sprint(parent)
 
@@ -380,11 +579,10 @@ def prepare_issue_for_cloning(parent, new_summary, sub_tasks):
 
         if linked_issue_key:
             # Recreate the link between the clone_issue_key and the linked_issue_key
-            link_list.append({"type": link_type, "inwardIssue": linked_issue_key if is_inward else None,
-                              "outwardIssue": linked_issue_key if not is_inward else None})
-
-    for link_data in link_list:
-        logger.info(f"Link type={link_data.get('type')} inwardIssue={link_data.get('inwardIssue')} outwardIssue={link_data.get('outwardIssue')}")
+            link_data = {"type": link_type, "inwardIssue": linked_issue_key if is_inward else None,
+                         "outwardIssue": linked_issue_key if not is_inward else None}
+            link_list.append(link_data)
+            logger.debug("Link type=%(type)s inwardIssue=%(inwardIssue)s outwardIssue=%(outwardIssue)s", link_data)
 
     sub_tasks_to_move = []
     for sub_task in sub_tasks:
@@ -399,16 +597,16 @@ def prepare_issue_for_cloning(parent, new_summary, sub_tasks):
     return cloned_issue
 
 
-def clone_jira(to_be_cloned_issue):
+def _clone_follow_ups(to_be_cloned_issue, new_issue):
+    """
+    Adds the comment, recreates the links and moves the sub-tasks of a newly created clone. These only depend on the
+    new issue, not on each other, so they are all sent in parallel.
+    """
     parent = to_be_cloned_issue["parent"]
-    #Create the new issue
-    fields = to_be_cloned_issue["fields"]
-    new_issue = create_issue(fields=fields)
-    logger.info(f"new_issue={new_issue.key}")
 
     #Add the comment to the cloned issue
     comment_text = to_be_cloned_issue["comment_text"]
-    add_comment(new_issue.key, comment_text)
+    calls = [functools.partial(add_comment, new_issue.key, comment_text)]
 
     #Recreate the links between the clone_issue_key and the linked_issue_key
     link_list = to_be_cloned_issue["link_list"]
@@ -416,13 +614,15 @@ def clone_jira(to_be_cloned_issue):
         inward_issue = link.get("inwardIssue") if link.get("inwardIssue") else new_issue.key
         outward_issue = link.get("outwardIssue") if link.get("outwardIssue") else new_issue.key
 
-        create_issue_link(
+        calls.append(functools.partial(
+            create_issue_link,
             type=link.get("type"),
             inwardIssue=inward_issue,
             outwardIssue=outward_issue
-        )
+        ))
 
-    create_issue_link(type="clones", inwardIssue=new_issue.key, outwardIssue=parent.key)
+    calls.append(functools.partial(create_issue_link, type="clones", inwardIssue=new_issue.key,
+                                   outwardIssue=parent.key))
 
     for sub_task in to_be_cloned_issue["sub_tasks_to_move"]:
         fields = {'parent': {'key': new_issue.key}}
@@ -430,94 +630,191 @@ def clone_jira(to_be_cloned_issue):
         # latest_sub_task = issue(sub_task.get('Key'))
         # latest_sub_task.update(fields=fields)
         sub_task_issue = sub_task.get("issue")
-        logger.info(f"Moving sub-task {sub_task_issue.key} from {parent.key} to {new_issue.key}")
-        sub_task_issue.update(fields=fields)
+        logger.info("Moving sub-task %s from %s to %s", sub_task_issue.key, parent.key, new_issue.key)
+        calls.append(functools.partial(sub_task_issue.update, fields=fields))
+
+    try:
+        run_in_parallel(calls)
+    finally:
+        for sub_task in to_be_cloned_issue["sub_tasks_to_move"]:
+            invalidate_issue(sub_task.get("issue"))
+
+
+def clone_jira(to_be_cloned_issue):
+    #Create the new issue
+    fields = to_be_cloned_issue["fields"]
+    new_issue = create_issue(fields=fields)
+    logger.info("new_issue=%s", new_issue.key)
 
+    _clone_follow_ups(to_be_cloned_issue, new_issue)
     return new_issue
 
 
 def clone_jiras(to_be_cloned_list):
+    """
+    Clones the issues. The new issues are created one at a time in the order of to_be_cloned_list, so they are ranked
+    in that order, then their comments, links and sub-task moves are sent in parallel.
+
+    :return: The new issues, in the same order as to_be_cloned_list.
+    :raises Exception: The first error. The issues created before it are attached to the error as new_issue_list.
+    """
     new_issue_list = []
+    error = None
     for to_be_cloned_issue in to_be_cloned_list:
-        new_issue_list.append(clone_jira(to_be_cloned_issue))
+        try:
+            new_issue = create_issue(fields=to_be_cloned_issue["fields"])
+        except Exception as e:
+            logger.error("Cloning stopped after %d of %d issues: %s", len(new_issue_list), len(to_be_cloned_list), e)
+            error = e
+            break
+        logger.info("new_issue=%s", new_issue.key)
+        new_issue_list.append(new_issue)
+
+    # The clones created before an error still get their comments, links and sub-tasks
+    results = run_in_parallel([functools.partial(_clone_follow_ups, to_be_cloned_issue, new_issue)
+                               for to_be_cloned_issue, new_issue in zip(to_be_cloned_list, new_issue_list)],
+                              max_workers=max_concurrent_clones, return_exceptions=True)
+    error = error or next((result for result in results if isinstance(result, Exception)), None)
+    if error is not None:
+        error.new_issue_list = new_issue_list
+        raise error
     return new_issue_list
 
 def get_board_id():
     global jira, board_url
-    match = re.search(r'boards/(\d+)', board_url)
+    board_id = _board_id_cache.get(board_url)
+    if board_id:
+        return board_id
+    match = _BOARD_ID_RE.search(board_url) if board_url else None
     if match:
-        return match.group(1)
+        board_id = _board_id_cache[board_url] = match.group(1)
+        return board_id
     else:
-        logger.error(f"Board ID not found in the JIRA URL {JIRA_URL}")
+        logger.error("Board ID not found in the board URL %s", board_url)
+
+def _active_sprints(board_id):
+    cached = _active_sprint_cache.get(board_id)
+    if cached and cached[0] > time.monotonic():
+        return cached[1]
+    sprints = jira.sprints(board_id, state="active")
+    _active_sprint_cache[board_id] = (time.monotonic() + ACTIVE_SPRINT_TTL_SECONDS, sprints)
+    return sprints
+
+def invalidate_active_sprint():
+    """
+    Drops the cached active sprints, e.g. after starting or closing a sprint.
+    """
+    _active_sprint_cache.clear()
 
 def get_active_sprint():
+    """
+    Returns the active sprint of the board. The lookup is cached for ACTIVE_SPRINT_TTL_SECONDS per board.
+    """
     global jira
     board_id = get_board_id()
     if board_id:
         try:
-            sprints = jira.sprints(board_id, state="active")
+            sprints = _active_sprints(board_id)
             if sprints:
                 return sprints[0]
         except IndexError:
-            logger.warning(f"No active sprint found for board_id={board_id}")
+            logger.warning("No active sprint found for board_id=%s", board_id)
     return None
 
 def set_board_url(url):
     global board_url
     board_url = url
+    _board_id_cache.clear()
+
+def _search_user_id(email_id):
+    user = jira.search_users(query=email_id)
+    if user:
+        user_id = user[0].accountId
+        email_to_user_id_map[email_id] = user_id
+        return user_id
+    logger.error("User with email %s not found.", email_id)
+    return None
 
 def get_user_id(email_id):
     global jira
     user_id = email_to_user_id_map.get(email_id)
     if not user_id:
-        user = jira.search_users(query=email_id)
-        if user:
-            user_id = user[0].accountId
-            email_to_user_id_map[email_id] = user_id
-        else:
-            logger.error(f"User with email {email_id} not found.")
+        user_id = _search_user_id(email_id)
     return user_id
 
+def prefetch_user_ids(email_ids):
+    """
+    Looks up the user ids of the emails that are not cached yet in parallel, so a following loop of get_user_id calls
+    doesn't do one search per email.
+
+    :param email_ids: The emails to look up. Duplicates and already cached emails are skipped.
+    """
+    missing = [email_id for email_id in dict.fromkeys(email_ids) if email_id not in email_to_user_id_map]
+    run_in_parallel([functools.partial(_search_user_id, email_id) for email_id in missing])
+
 ####### Borrowed from https://github.com/eshack94/md-to-jira. Works like a charm! ########
+_MD_SPECIALS = frozenset('#*_`~[')
+_HEADER_RE = re.compile(r'^(#{1,6})\s*(.+)')
+_BOLD_STAR_RE = re.compile(r'\*\*(.+?)\*\*')
+_BOLD_UNDERSCORE_RE = re.compile(r'__(.+?)__')
+_ITALIC_STAR_RE = re.compile(r'\*(.+?)\*')
+_ITALIC_UNDERSCORE_RE = re.compile(r'_(.+?)_')
+_INLINE_CODE_RE = re.compile(r'`([^`]+)`')
+_STRIKETHROUGH_RE = re.compile(r'~~(.+?)~~')
+_LINK_RE = re.compile(r'\[(.*?)\]\((.+?)\)')
+_LIST_RE = re.compile(r'^\*\s+')
+_TASK_LIST_RE = re.compile(r'^\s*-\s*\[(x|X| )\]')
+_FENCE_RE = re.compile(r'```(\w+)?\n(.*?)\n```', re.MULTILINE | re.DOTALL)
+_INDENT_RE = re.compile(r'((?:^ {4}.*\n?)+)', re.MULTILINE)
+_INDENT_PREFIX_RE = re.compile(r'^ {4}|\t', re.MULTILINE)
+
+
+def _header_replacement(match):
+    return f'h{len(match.group(1))}. {match.group(2)}'
+
+
 def convert_line(line):
-    # Convert headers
-    line = re.sub(r'^#{6}\s*(.+)', r'h6. \1', line)
-    line = re.sub(r'^#{5}\s*(.+)', r'h5. \1', line)
-    line = re.sub(r'^#{4}\s*(.+)', r'h4. \1', line)
-    line = re.sub(r'^#{3}\s*(.+)', r'h3. \1', line)
-    line = re.sub(r'^#{2}\s*(.+)', r'h2. \1', line)
-    line = re.sub(r'^#\s*(.+)', r'h1. \1', line)
+    # Every conversion below needs one of these characters, most plain text lines have none of them
+    if _MD_SPECIALS.isdisjoint(line):
+        return line
+
+    # Convert headers. "#" to "######" become h1. to h6., the level is the number of leading #
+    if line.startswith('#'):
+        line = _HEADER_RE.sub(_header_replacement, line, count=1)
 
     # Convert bold and italic
-    line = re.sub(r'\*\*(.+?)\*\*', r'*\1*', line)
-    line = re.sub(r'__(.+?)__', r'*\1*', line)
-    line = re.sub(r'\*(.+?)\*', r'_\1_', line)
-    line = re.sub(r'_(.+?)_', r'_\1_', line)
+    line = _BOLD_STAR_RE.sub(r'*\1*', line)
+    line = _BOLD_UNDERSCORE_RE.sub(r'*\1*', line)
+    line = _ITALIC_STAR_RE.sub(r'_\1_', line)
+    line = _ITALIC_UNDERSCORE_RE.sub(r'_\1_', line)
 
     # Convert inline code
-    line = re.sub(r'`([^`]+)`', r'{{\1}}', line)
+    line = _INLINE_CODE_RE.sub(r'{{\1}}', line)
 
     # Convert strikethrough
-    line = re.sub(r'~~(.+?)~~', r'-\1-', line)
+    line = _STRIKETHROUGH_RE.sub(r'-\1-', line)
 
     # Convert links
-    line = re.sub(r'\[(.*?)\]\((.+?)\)', r'[\1|\2]', line)
+    line = _LINK_RE.sub(r'[\1|\2]', line)
 
     # Convert unordered lists
-    line = re.sub(r'^\*\s+', r'- ', line)
+    line = _LIST_RE.sub(r'- ', line)
 
     # Convert GFM task lists
-    line = re.sub(r'^\s*-\s*\[(x|X| )\]', lambda match: f'[{match.group(1)}]', line)
+    line = _TASK_LIST_RE.sub(lambda match: f'[{match.group(1)}]', line)
 
     return line
 
 
 def convert_multiline_elements(content):
-    # Convert multiline fenced code blocks
-    content = re.sub(r'```(\w+)?\n(.*?)\n```', process_code_block, content, flags=re.MULTILINE | re.DOTALL)
+    # Convert multiline fenced code blocks. The substring checks skip the whole-text regex sweeps for the common case
+    # of content without code blocks
+    if '```' in content:
+        content = _FENCE_RE.sub(process_code_block, content)
 
     # Convert indented code blocks
-    content = re.sub(r'((?:^ {4}.*\n?)+)', process_indented_code_block, content, flags=re.MULTILINE)
+    if '    ' in content:
+        content = _INDENT_RE.sub(process_indented_code_block, content)
 
     return content
 
@@ -534,7 +831,7 @@ def process_code_block(match):
 def process_indented_code_block(match):
     code = match.group(1)
     # Remove the leading 4 spaces or tab from each line
-    code = re.sub(r'^ {4}|\t', '', code, flags=re.MULTILINE)
+    code = _INDENT_PREFIX_RE.sub('', code)
     return f'{{code}}\n{code}{{code}}\n'
 
 
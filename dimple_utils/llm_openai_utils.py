@@ -1,8 +1,15 @@
-from openai import OpenAI
-from dimple_utils import config_utils
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from openai import OpenAI, RateLimitError, APITimeoutError, APIConnectionError, InternalServerError
+from dimple_utils import config_utils, llm_utils
 from privacera_shield import client as privacera_shield_client
 from privacera_shield.model import ConversationType
+import hashlib
+import json
 import os
+import random
+import re
+import threading
 import time
 import logging
 import uuid
@@ -10,20 +17,51 @@ import uuid
 # These are the global variables that are updated during initialization. Any method using these variables should
 # declare them as global in the method.
 openai_client = None
+_initialized = False
+_initialize_lock = threading.Lock()
 openai_model = "gpt-4o"
+# Retries back off exponentially from retry_delay_base seconds, doubling per attempt up to retry_delay seconds
 retry_delay = 60
+retry_delay_base = 4
 max_retries = 5
 max_response_tokens = 4096
+max_concurrent_requests = 5
+# After this many rate limit/connection failures in a row, calls fail fast with CircuitOpenError for
+# circuit_cooldown seconds. Then one call is let through, and the circuit closes again if it succeeds
+circuit_failure_threshold = 10
+circuit_cooldown = 60
+_circuit_failures = 0
+_circuit_open_until = 0.0
+_circuit_lock = threading.Lock()
+# OpenAI replies are cached by user, model, max tokens and prompt when enabled (openai.response.cache.enabled). All
+# requests use temperature 0, so a repeated prompt gets the same reply. Only the OpenAI request is skipped on a hit,
+# the prompt and the reply still go through the shield checks and their audit.
+response_cache_enabled = False
+response_cache_max_items = 1000
+response_cache_stats = {"hits": 0, "misses": 0}
+_response_cache = OrderedDict()
+_response_cache_lock = threading.Lock()
 
 # These are static variables that are not updated during initialization
+# Context window sizes in tokens. max_tokens is lowered to fit prompts for these models, see _response_token_budget
+MODEL_CONTEXT_WINDOWS = {"gpt-4o": 128000, "gpt-4o-mini": 128000, "gpt-4-turbo": 128000, "gpt-4": 8192,
+                         "gpt-3.5-turbo": 16385}
+# Tokens reserved for the chat message formatting around the prompt
+_MESSAGE_TOKEN_MARGIN = 64
 rate_limit_error_list = ["Rate limit reached for", "Read timed out", "Connection reset by peer",
                          "The server is overloaded or not ready yet"]
+# OpenAI errors that are retried by type. rate_limit_error_list catches the rest, e.g. errors from a proxy
+_RETRYABLE_ERRORS = (RateLimitError, APITimeoutError, APIConnectionError, InternalServerError)
+# rate_limit_error_list as one pattern, compiled again by initialize() in case the list was changed
+_rate_limit_error_re = re.compile("|".join(map(re.escape, rate_limit_error_list)))
 
 
 def initialize():
-    global openai_client, openai_model, retry_delay, max_retries, max_response_tokens
+    global openai_client, openai_model, retry_delay, retry_delay_base, max_retries, max_response_tokens, \
+        max_concurrent_requests, response_cache_enabled, response_cache_max_items, circuit_failure_threshold, \
+        circuit_cooldown, _rate_limit_error_re, _initialized
     openai_key_file = config_utils.get_property("openai.key.file", section="OPENAI", fallback="openai_key_dont_commit.txt")
-    logging.info(f"Initializing OpenAI with key file: {openai_key_file}")
+    logging.info("Initializing OpenAI with key file: %s", openai_key_file)
     # Load the OpenAI key from its file
     with open(openai_key_file, 'r') as f:
         openai_key = f.read().strip()
@@ -31,15 +69,173 @@ def initialize():
     openai_client = OpenAI(api_key=openai_key)
     openai_model = config_utils.get_property("openai.model", section="OPENAI", fallback=openai_model)
     retry_delay = config_utils.get_int_property("openai.retry.delay", section="OPENAI", fallback=retry_delay)
+    retry_delay_base = config_utils.get_float_property("openai.retry.delay.base", section="OPENAI",
+                                                       fallback=retry_delay_base)
     max_retries = config_utils.get_int_property("openai.max.retries", section="OPENAI", fallback=max_retries)
     max_response_tokens = config_utils.get_int_property("openai.max.response_tokens", section="OPENAI", fallback=max_response_tokens)
+    max_concurrent_requests = config_utils.get_int_property("openai.max.concurrent_requests", section="OPENAI",
+                                                            fallback=max_concurrent_requests)
+    response_cache_enabled = config_utils.get_bool_property("openai.response.cache.enabled", section="OPENAI",
+                                                            fallback=response_cache_enabled)
+    response_cache_max_items = config_utils.get_int_property("openai.response.cache.max_items", section="OPENAI",
+                                                             fallback=response_cache_max_items)
+    circuit_failure_threshold = config_utils.get_int_property("openai.circuit.failure_threshold", section="OPENAI",
+                                                              fallback=circuit_failure_threshold)
+    circuit_cooldown = config_utils.get_int_property("openai.circuit.cooldown", section="OPENAI",
+                                                     fallback=circuit_cooldown)
+    _rate_limit_error_re = re.compile("|".join(map(re.escape, rate_limit_error_list)))
+    clear_response_cache()
 
-    logging.info(f"openai_model={openai_model}, retry_delay={retry_delay}, max_retries={max_retries}, max_response_tokens={max_response_tokens}")
-    logging.info(f"OpenAI Initialized. openai_model will be {openai_model}!!!")
+    logging.info("openai_model=%s, retry_delay=%s, retry_delay_base=%s, max_retries=%s, max_response_tokens=%s",
+                 openai_model, retry_delay, retry_delay_base, max_retries, max_response_tokens)
+    logging.info("OpenAI Initialized. openai_model will be %s!!!", openai_model)
+    _initialized = True
 
 
-def infer_query(prompt, paig_service_user, log_msg=""):
+def _ensure_initialized():
+    """
+    Calls initialize() on first use if the application hasn't. The lock makes sure concurrent first calls, e.g. from
+    batch_infer_query, create only one client.
+    """
+    if _initialized:
+        return
+    with _initialize_lock:
+        if not _initialized:
+            initialize()
 
+
+def _response_cache_key(prompt, paig_service_user, system_prompt):
+    key = json.dumps({"user": paig_service_user, "model": openai_model, "max_tokens": max_response_tokens,
+                      "system_prompt": system_prompt,
+                      "prompt": prompt}, sort_keys=True)
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+def clear_response_cache():
+    """
+    Drops the cached replies and resets response_cache_stats.
+    """
+    with _response_cache_lock:
+        _response_cache.clear()
+        response_cache_stats["hits"] = 0
+        response_cache_stats["misses"] = 0
+
+
+def infer_query(prompt, paig_service_user, log_msg="", system_prompt=None):
+    """
+    Sends the prompt to OpenAI through the shield and returns the reply.
+
+    :param prompt: The prompt. It is checked by the shield.
+    :param paig_service_user: The user for the shield context.
+    :param log_msg: Appended to the retry log messages.
+    :param system_prompt: Optional fixed instructions, sent as a system message before the prompt. It is not checked by
+    the shield, so it must not contain user data. OpenAI caches the processing of a repeated prompt prefix, keeping
+    the instructions here instead of in front of a changing prompt makes repeated calls cheaper and faster.
+    """
+    _ensure_initialized()
+    return _infer_query(prompt, paig_service_user, log_msg, system_prompt)
+
+
+class CircuitOpenError(Exception):
+    """
+    Raised instead of calling OpenAI while the circuit is open after repeated failures. It is not retried.
+    """
+    pass
+
+
+def _circuit_before_call():
+    global _circuit_open_until
+    with _circuit_lock:
+        if _circuit_failures < circuit_failure_threshold:
+            return
+        now = time.monotonic()
+        if now < _circuit_open_until:
+            raise CircuitOpenError(f"OpenAI calls are failing, not calling it for another "
+                                   f"{_circuit_open_until - now:.0f} seconds")
+        # Half open. This call probes OpenAI, the other calls keep failing fast until it is done
+        _circuit_open_until = now + circuit_cooldown
+
+
+def _circuit_record(success):
+    global _circuit_failures, _circuit_open_until
+    with _circuit_lock:
+        if success:
+            _circuit_failures = 0
+            return
+        _circuit_failures += 1
+        if _circuit_failures >= circuit_failure_threshold:
+            _circuit_open_until = time.monotonic() + circuit_cooldown
+
+
+def _is_retryable_error(error):
+    # The type check comes first, it avoids formatting the error (which can include the whole response body)
+    return isinstance(error, _RETRYABLE_ERRORS) or _rate_limit_error_re.search(str(error)) is not None
+
+
+def _retry_backoff(attempt):
+    """
+    Returns the seconds to wait before retrying after the given attempt. The jitter keeps concurrent callers that
+    were rate limited together from retrying together.
+    """
+    delay = min(retry_delay, retry_delay_base * (2 ** attempt))
+    return delay + random.uniform(0, delay * 0.1)
+
+
+def _response_token_budget(messages):
+    """
+    Returns max_response_tokens, lowered so the prompt and the reply fit in the context window of the model. Raises
+    ValueError without calling OpenAI when the prompt alone doesn't fit, the request would be rejected anyway.
+    """
+    context_window = MODEL_CONTEXT_WINDOWS.get(openai_model)
+    if not context_window:
+        return max_response_tokens
+    # Counted as plain text, a prompt containing e.g. <|endoftext|> is sent to OpenAI as is and mustn't raise here
+    prompt_tokens = sum(llm_utils.num_tokens_from_strings([message["content"] for message in messages], openai_model))
+    budget = context_window - prompt_tokens - _MESSAGE_TOKEN_MARGIN
+    if budget <= 0:
+        raise ValueError(f"The prompt has {prompt_tokens} tokens, which doesn't fit in the {context_window} token "
+                         f"context window of {openai_model}")
+    return min(max_response_tokens, budget)
+
+
+def _chat_completion(prompt_text, system_prompt, log_msg):
+    """
+    Sends the prompt (already checked by the shield) to OpenAI, retrying on the rate limit errors, and returns the
+    reply text.
+    """
+    # The request is the same for every attempt, build it once. The system prompt goes first, so the prefix stays the
+    # same across calls
+    messages = [{"role": "system", "content": system_prompt}] if system_prompt else []
+    messages.append({"role": "user", "content": prompt_text})
+    request = {"model": openai_model, "messages": messages, "temperature": 0,
+               "max_tokens": _response_token_budget(messages)}
+    for attempt in range(max_retries):
+        _circuit_before_call()
+        try:
+            start_ns = time.perf_counter_ns()
+            response = openai_client.chat.completions.create(**request)
+            logging.debug("OpenAI request took %d ms. %s", (time.perf_counter_ns() - start_ns) // 1_000_000, log_msg)
+            _circuit_record(True)
+            break
+        except Exception as e:
+            if _is_retryable_error(e):
+                _circuit_record(False)
+                if attempt < max_retries - 1:
+                    delay = _retry_backoff(attempt)
+                    logging.warning("Failed to execute. Attempt= %d/%d. We will retry after %.1f seconds. "
+                                    "exception=%s %s", attempt + 1, max_retries, delay, e, log_msg)
+                    time.sleep(delay)
+                    continue
+                else:
+                    raise Exception(f"Failed to execute infer_query after {max_retries} attempts. {log_msg}") from e
+            raise
+
+    return response.choices[0].message.content
+
+
+def _infer_query(prompt, paig_service_user, log_msg, system_prompt):
+
+    # The shield context is only held for the shield checks, not during the OpenAI request and its retries
     with privacera_shield_client.create_shield_context(username=paig_service_user):
         thread_id = str(uuid.uuid4())
         updated_prompt_text = privacera_shield_client.check_access(
@@ -49,26 +245,27 @@ def infer_query(prompt, paig_service_user, log_msg=""):
         )
         updated_prompt_text = updated_prompt_text[0].response_text
 
-        for attempt in range(max_retries):
-            try:
-                response = openai_client.chat.completions.create(model=openai_model,
-                                                                 messages=[{"role": "user", "content": updated_prompt_text}],
-                                                                 temperature=0,
-                                                                 max_tokens=max_response_tokens)
-                break
-            except Exception as e:
-                if any(msg in str(e) for msg in rate_limit_error_list):
-                    if attempt < max_retries - 1:
-                        logging.warning(f"Failed to execute. Attempt= {attempt + 1}/{max_retries}. "
-                                       f"We will retry after {retry_delay} seconds. exception={e} {log_msg}")
-                        time.sleep(retry_delay)
-                        continue
-                    else:
-                        raise Exception(f"Failed to execute {func.__name__} after {max_retries} attempts. {log_msg}") from e
-                raise
+    if not response_cache_enabled:
+        llm_response = _chat_completion(updated_prompt_text, system_prompt, log_msg)
+    else:
+        # The cache key is the prompt after the shield check, the text that is actually sent to OpenAI
+        cache_key = _response_cache_key(updated_prompt_text, paig_service_user, system_prompt)
+        with _response_cache_lock:
+            llm_response = _response_cache.get(cache_key)
+            if llm_response is not None:
+                _response_cache.move_to_end(cache_key)
+                response_cache_stats["hits"] += 1
+            else:
+                response_cache_stats["misses"] += 1
+        if llm_response is None:
+            llm_response = _chat_completion(updated_prompt_text, system_prompt, log_msg)
+            with _response_cache_lock:
+                _response_cache[cache_key] = llm_response
+                if len(_response_cache) > response_cache_max_items:
+                    _response_cache.popitem(last=False)
 
+    with privacera_shield_client.create_shield_context(username=paig_service_user):
         try:
-            llm_response = response.choices[0].message.content
             updated_reply_text = privacera_shield_client.check_access(
                 text=llm_response,
                 conversation_type=ConversationType.REPLY,
@@ -76,6 +273,102 @@ def infer_query(prompt, paig_service_user, log_msg=""):
             )
             updated_reply_text = updated_reply_text[0].response_text
         except Exception as e:
-            logging.error(f"Error while processing LLM response. Won't alter prompt and also will continue: PROMPT={prompt}, exception={e}", exc_info=True)
+            logging.error("Error while processing LLM response. Won't alter prompt and also will continue: PROMPT=%s, "
+                          "exception=%s", prompt, e, exc_info=True)
+
+    return updated_reply_text
+
+
+def batch_infer_query(prompts, paig_service_user, log_msg="", max_workers=None, system_prompt=None):
+    """
+    Runs infer_query for each prompt with up to max_workers requests in flight, so the LLM round trips overlap. Each
+    request still retries on the rate limit errors like infer_query does. Tune max_workers to the token per minute
+    quota of the account, more workers only means more rate limit retries once the quota is reached.
+
+    :param prompts: The prompts to run.
+    :param paig_service_user: The user for the shield context, see infer_query.
+    :param log_msg: Appended to the retry log messages.
+    :param max_workers: Maximum number of concurrent requests. Defaults to max_concurrent_requests.
+    :param system_prompt: Optional instructions sent before every prompt, see infer_query.
+    :return: The replies, in the same order as prompts.
+    """
+    if not prompts:
+        return []
+    max_workers = max_workers or max_concurrent_requests
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(prompts))) as executor:
+        return list(executor.map(lambda prompt: infer_query(prompt, paig_service_user, log_msg, system_prompt),
+                                 prompts))
+
+
+def submit_batch(prompts, paig_service_user):
+    """
+    Submits the prompts to the OpenAI Batch API, which costs half as much but completes within 24 hours. Use it for
+    offline jobs that don't need the replies right away. The prompts go through the shield like in infer_query.
 
-        return updated_reply_text
+    :param prompts: The prompts to run.
+    :param paig_service_user: The user for the shield context, see infer_query.
+    :return: The batch id to pass to fetch_batch.
+    """
+    _ensure_initialized()
+    lines = []
+    with privacera_shield_client.create_shield_context(username=paig_service_user):
+        for index, prompt in enumerate(prompts):
+            # The custom_id carries the position of the prompt and the shield thread id of its conversation
+            thread_id = str(uuid.uuid4())
+            updated_prompt_text = privacera_shield_client.check_access(
+                text=prompt,
+                conversation_type=ConversationType.PROMPT,
+                thread_id=thread_id
+            )[0].response_text
+            lines.append(json.dumps({
+                "custom_id": f"{index}:{thread_id}",
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": {"model": openai_model, "messages": [{"role": "user", "content": updated_prompt_text}],
+                         "temperature": 0, "max_tokens": max_response_tokens}
+            }))
+
+    batch_file = openai_client.files.create(file=("batch.jsonl", "\n".join(lines).encode()), purpose="batch")
+    batch = openai_client.batches.create(input_file_id=batch_file.id, endpoint="/v1/chat/completions",
+                                         completion_window="24h")
+    logging.info("Submitted batch %s with %d prompts", batch.id, len(lines))
+    return batch.id
+
+
+def fetch_batch(batch_id, paig_service_user, poll_interval=60):
+    """
+    Waits for a batch submitted with submit_batch to finish and returns its replies. The replies go through the shield
+    like in infer_query.
+
+    :param batch_id: The id returned by submit_batch.
+    :param paig_service_user: The user for the shield context, see infer_query.
+    :param poll_interval: Seconds to wait between status checks.
+    :return: The replies, in the same order as the submitted prompts. None for the prompts that failed.
+    """
+    _ensure_initialized()
+    batch = openai_client.batches.retrieve(batch_id)
+    while batch.status not in ("completed", "failed", "expired", "cancelled"):
+        logging.info("Batch %s is %s. Checking again in %s seconds", batch_id, batch.status, poll_interval)
+        time.sleep(poll_interval)
+        batch = openai_client.batches.retrieve(batch_id)
+
+    if batch.status != "completed":
+        raise Exception(f"Batch {batch_id} finished with status {batch.status}")
+
+    replies = [None] * batch.request_counts.total
+    if not batch.output_file_id:
+        return replies
+    with privacera_shield_client.create_shield_context(username=paig_service_user):
+        for line in openai_client.files.content(batch.output_file_id).text.splitlines():
+            result = json.loads(line)
+            index, _, thread_id = result["custom_id"].partition(":")
+            response = result.get("response")
+            if not response or response.get("status_code") != 200:
+                logging.error("Batch %s request %s failed: %s", batch_id, index, result.get("error"))
+                continue
+            replies[int(index)] = privacera_shield_client.check_access(
+                text=response["body"]["choices"][0]["message"]["content"],
+                conversation_type=ConversationType.REPLY,
+                thread_id=thread_id
+            )[0].response_text
+    return replies
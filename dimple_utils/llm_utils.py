@@ -1,6 +1,81 @@
+import functools
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
 import tiktoken
 
+# Token counts of strings up to this length are cached by the string itself, which keeps at most about 4096 x 1000
+# characters alive. Longer strings are cached by a digest of their content, so the cache doesn't keep them alive
+MAX_CACHED_STRING_LENGTH = 1000
+# num_tokens_from_strings encodes fewer strings than this directly, a thread pool costs more than it saves for them
+MIN_BATCH_ENCODE_STRINGS = 16
+
+
+@functools.lru_cache(maxsize=32)
+def _get_encoding(model_name):
+    return tiktoken.encoding_for_model(model_name)
+
+
+@functools.lru_cache(maxsize=4096)
+def _cached_num_tokens(string, model_name):
+    return len(_get_encoding(model_name).encode_ordinary(string))
+
+
+_long_string_counts = OrderedDict()
+_long_string_counts_max_items = 10000
+_long_string_counts_lock = threading.Lock()
+
+
 def num_tokens_from_string(string: str, model_name) -> int:
-    encoding = tiktoken.encoding_for_model(model_name)
-    num_tokens = len(encoding.encode(string))
+    """
+    Counts the tokens of a string. Special tokens such as <|endoftext|> are counted as plain text instead of raising
+    an error, the same as num_tokens_from_strings.
+    """
+    if len(string) <= MAX_CACHED_STRING_LENGTH:
+        return _cached_num_tokens(string, model_name)
+
+    # Hashing is a small fraction of the cost of encoding
+    key = (hashlib.blake2b(string.encode("utf-8", "surrogatepass"), digest_size=16).digest(), model_name)
+    with _long_string_counts_lock:
+        if key in _long_string_counts:
+            _long_string_counts.move_to_end(key)
+            return _long_string_counts[key]
+    num_tokens = len(_get_encoding(model_name).encode_ordinary(string))
+    with _long_string_counts_lock:
+        _long_string_counts[key] = num_tokens
+        if len(_long_string_counts) > _long_string_counts_max_items:
+            _long_string_counts.popitem(last=False)
     return num_tokens
+
+
+def token_cache_info():
+    """
+    Returns the hits, misses and sizes of the token count caches, e.g. to check how effective they are.
+    """
+    return {"short_strings": _cached_num_tokens.cache_info()._asdict(), "long_strings": len(_long_string_counts)}
+
+
+def num_tokens_from_strings(strings, model_name):
+    """
+    Counts the tokens of several strings at once. tiktoken encodes the batch on parallel threads outside the GIL,
+    which is much faster than calling num_tokens_from_string in a loop for many strings. Fewer than
+    MIN_BATCH_ENCODE_STRINGS distinct strings are counted with num_tokens_from_string instead. Special tokens such as
+    <|endoftext|> are counted as plain text instead of raising an error.
+
+    :param strings: The strings to count.
+    :param model_name: The model whose encoding is used.
+    :return: The token counts, in the same order as strings.
+    """
+    strings = list(strings)
+    # Identical strings (e.g. boilerplate) are encoded once
+    unique_strings = list(dict.fromkeys(strings))
+    if len(unique_strings) < MIN_BATCH_ENCODE_STRINGS:
+        counts = {string: num_tokens_from_string(string, model_name) for string in unique_strings}
+    else:
+        encoding = _get_encoding(model_name)
+        num_threads = max(1, min(os.cpu_count() or 1, len(unique_strings)))
+        counts = dict(zip(unique_strings, (len(tokens) for tokens in encoding.encode_ordinary_batch(
+            unique_strings, num_threads=num_threads))))
+    return [counts[string] for string in strings]
@@ -11,7 +11,7 @@ setup(
     packages=find_packages(),
     install_requires=[
         "requests>=2.26.0",
-        "jira"
+        "jira>=3.5.0"
     ],
     extras_require={
         "dev": ["pytest", "flake8"],  # Development dependencies
@@ -1,25 +1,36 @@
 import unittest
 from unittest import mock
 import os
+import tempfile
 import configparser
-from dimple_utils.config_utils import load_properties, get_property, get_int_property, get_bool_property, get_float_property, get_secret
+from dimple_utils.config_utils import load_properties, print_properties, get_property, get_int_property, get_bool_property, get_float_property, get_secret, set_property
+from dimple_utils import config_utils
+from dimple_utils.config_utils import _read_properties_file
+
+TEST_DEFAULT_FILE = os.path.join(os.path.dirname(__file__), 'test_default.properties')
 
 class TestConfigUtils(unittest.TestCase):
 
+    def setUp(self):
+        # Never write the parse cache outside the test, even if DIMPLE_CONFIG_CACHE_DIR is set
+        patcher = mock.patch('dimple_utils.config_utils.CONFIG_CACHE_DIR', None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
     @mock.patch('dimple_utils.config_utils.os.getenv', return_value=None)
-    @mock.patch('dimple_utils.config_utils.configparser.ConfigParser.read')
+    @mock.patch('dimple_utils.config_utils._read_properties_file')
     def test_load_properties_default(self, mock_read, mock_getenv):
         """
         Test loading default properties without an override or secrets file.
         """
         config = load_properties(default_file='test_default.properties')
 
-        mock_read.assert_called_once_with('test_default.properties')
+        mock_read.assert_called_once_with(mock.ANY, 'test_default.properties', mock.ANY)
 
 
     @mock.patch('dimple_utils.config_utils.os.getenv', return_value=None)  # Ensure no OVERRIDE_FILE environment variable
     @mock.patch('dimple_utils.config_utils.os.path.exists', return_value=False)  # Simulate that override file doesn't exist
-    @mock.patch('dimple_utils.config_utils.configparser.ConfigParser.read')
+    @mock.patch('dimple_utils.config_utils._read_properties_file')
     def test_load_properties_no_override(self, mock_read, mock_path_exists, mock_getenv):
         """
         Test loading properties when the override file is not found.
@@ -27,68 +38,133 @@ class TestConfigUtils(unittest.TestCase):
         config = load_properties(default_file='test_default.properties')
 
         # Ensure the default file is read
-        mock_read.assert_called_once_with('test_default.properties')
+        mock_read.assert_called_once_with(mock.ANY, 'test_default.properties', mock.ANY)
 
 
 
-    @mock.patch('dimple_utils.config_utils.configparser.ConfigParser')
-    def test_get_property(self, MockConfigParser):
+    @mock.patch('dimple_utils.config_utils.os.getenv', return_value=None)
+    def test_get_property(self, mock_getenv):
         """
         Test retrieving a string property.
         """
-        mock_config = MockConfigParser.return_value
-        mock_config.has_option.return_value = True
-        mock_config.get.return_value = '24'
+        load_properties(default_file=TEST_DEFAULT_FILE)
+        value = get_property('FETCH_LAST_HOURS', fallback='24')
 
-        load_properties(default_file='test_default.properties')
-        value = get_property('FETCH_LAST_HOURS', fallback='48')
+        self.assertEqual(value, '48')
+        self.assertEqual(get_property('MISSING_KEY', fallback='24'), '24')
 
-        self.assertEqual(value, '24')
-
-    @mock.patch('dimple_utils.config_utils.configparser.ConfigParser')
-    def test_get_int_property(self, MockConfigParser):
+    @mock.patch('dimple_utils.config_utils.os.getenv', return_value=None)
+    def test_get_int_property(self, mock_getenv):
         """
         Test retrieving an integer property.
         """
-        mock_config = MockConfigParser.return_value
-        mock_config.has_option.return_value = True
-        mock_config.getint.return_value = 24
+        load_properties(default_file=TEST_DEFAULT_FILE)
+        value = get_int_property('FETCH_LAST_HOURS', fallback=24)
 
-        load_properties(default_file='test_default.properties')
-        value = get_int_property('FETCH_LAST_HOURS', fallback=48)
+        self.assertEqual(value, 48)
 
-        self.assertEqual(value, 24)
-
-    @mock.patch('dimple_utils.config_utils.configparser.ConfigParser')
-    def test_get_bool_property(self, MockConfigParser):
+    @mock.patch('dimple_utils.config_utils.os.getenv', return_value=None)
+    def test_get_bool_property(self, mock_getenv):
         """
         Test retrieving a boolean property.
         """
-        mock_config = MockConfigParser.return_value
-        mock_config.has_option.return_value = True
-        mock_config.getboolean.return_value = True
-
-        load_properties(default_file='test_default.properties')
+        load_properties(default_file=TEST_DEFAULT_FILE)
         value = get_bool_property('ENABLE_FEATURE', fallback=False)
 
         self.assertTrue(value)
 
-    @mock.patch('dimple_utils.config_utils.configparser.ConfigParser')
-    def test_get_float_property(self, MockConfigParser):
+    @mock.patch('dimple_utils.config_utils.os.getenv', return_value=None)
+    def test_get_float_property(self, mock_getenv):
         """
         Test retrieving a float property.
         """
-        mock_config = MockConfigParser.return_value
-        mock_config.has_option.return_value = True
-        mock_config.getfloat.return_value = 12.5
-
-        load_properties(default_file='test_default.properties')
+        load_properties(default_file=TEST_DEFAULT_FILE)
         value = get_float_property('SOME_FLOAT', fallback=0.0)
 
         self.assertEqual(value, 12.5)
 
+    @mock.patch('dimple_utils.config_utils.os.getenv', return_value=None)
+    def test_set_property(self, mock_getenv):
+        """
+        Test that set_property is visible to the getters.
+        """
+        load_properties(default_file=TEST_DEFAULT_FILE)
+        set_property('FETCH_LAST_HOURS', '12')
+
+        self.assertEqual(get_int_property('FETCH_LAST_HOURS'), 12)
+
+    def _load_data(self, data):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            default_file = os.path.join(temp_dir, 'default.properties')
+            with open(default_file, 'w') as f:
+                f.write(data)
+            with mock.patch('dimple_utils.config_utils.os.getenv', return_value=None):
+                load_properties(default_file=default_file)
+
+    def test_set_property_interpolates(self):
+        """
+        Test values set with set_property are interpolated and values referring to them follow the change.
+        """
+        self._load_data("[DEFAULT]\nhost = h\nurl = %(host)s/p\n\n[S]\nname = s\n")
+
+        set_property('u2', '%(host)s/x')
+        self.assertEqual(get_property('u2'), 'h/x')
+
+        set_property('host', 'H2')
+        self.assertEqual(get_property('url'), 'H2/p')
+        self.assertEqual(get_property('url', section='S'), 'H2/p')
+        self.assertEqual(get_property('u2', section='S'), 'H2/x')
+
+    def test_set_property_keeps_section_values(self):
+        """
+        Test a DEFAULT value set with set_property doesn't replace an explicit section value, even an equal one.
+        """
+        self._load_data("[DEFAULT]\na = 1\n\n[S]\na = 1\n\n[T]\nname = t\n")
+
+        set_property('a', '9')
+
+        self.assertEqual(get_property('a'), '9')
+        self.assertEqual(get_property('a', section='S'), '1')
+        self.assertEqual(get_property('a', section='T'), '9')
+
+    def test_load_properties_literal_percent(self):
+        """
+        Test a value with a literal % loads and is returned as it is, without breaking the other values.
+        """
+        self._load_data("[DEFAULT]\nrate = 50%\nhost = h\nurl = %(host)s/p\n\n[S]\nname = s\n")
+
+        self.assertEqual(get_property('rate'), '50%')
+        self.assertEqual(get_property('rate', section='S'), '50%')
+        self.assertEqual(get_property('url', section='S'), 'h/p')
+        self.assertEqual(get_property('name', section='S'), 's')
+
+    def test_set_property_checks(self):
+        """
+        Test set_property rejects the values and sections ConfigParser.set rejects.
+        """
+        self._load_data("[DEFAULT]\na = 1\n")
+
+        with self.assertRaises(TypeError):
+            set_property('a', 2)
+        with self.assertRaises(configparser.NoSectionError):
+            set_property('a', '2', section='MISSING')
+        self.assertEqual(get_property('a'), '1')
+
+    @mock.patch.dict('dimple_utils.config_utils.os.environ',
+                     {'FETCH_LAST_HOURS': '72', 'DIMPLE_jira_dot_url': 'https://jira.example.com', 'UNRELATED': 'x'})
+    @mock.patch('dimple_utils.config_utils.os.getenv', return_value=None)
+    def test_load_properties_env_override(self, mock_getenv):
+        """
+        Test that only known or prefixed environment variables override the properties.
+        """
+        load_properties(default_file=TEST_DEFAULT_FILE)
+
+        self.assertEqual(get_int_property('FETCH_LAST_HOURS'), 72)
+        self.assertEqual(get_property('jira.url'), 'https://jira.example.com')
+        self.assertIsNone(get_property('UNRELATED'))
+
     @mock.patch('dimple_utils.config_utils.os.path.exists', return_value=True)
-    @mock.patch('dimple_utils.config_utils.configparser.ConfigParser.read')
+    @mock.patch('dimple_utils.config_utils._read_properties_file')
     def test_load_properties_with_secrets(self, mock_read, mock_path_exists):
         """
         Test loading properties with a secrets file.
@@ -96,36 +172,159 @@ class TestConfigUtils(unittest.TestCase):
         config = load_properties(default_file='test_default.properties', secrets_file='secrets.properties')
 
         # Ensure default and secrets files were read
-        mock_read.assert_any_call('test_default.properties')
-        mock_read.assert_any_call('secrets.properties')
+        mock_read.assert_any_call(mock.ANY, 'test_default.properties', mock.ANY)
+        mock_read.assert_any_call(mock.ANY, 'secrets.properties')
+
+    @mock.patch('dimple_utils.config_utils.os.getenv', return_value=None)
+    def test_load_properties_interpolates_defaults(self, mock_getenv):
+        """
+        Test that DEFAULT values are interpolated the same way as section values.
+        """
+        with tempfile.TemporaryDirectory() as temp_dir:
+            default_file = os.path.join(temp_dir, 'default.properties')
+            with open(default_file, 'w') as f:
+                f.write("[DEFAULT]\nbase = /opt/app\ndata = %(base)s/data\npct = 100%%\n\n[app]\nname = test\n")
+            load_properties(default_file=default_file)
 
-    @mock.patch('dimple_utils.config_utils.secret_config')
-    def test_get_secret(self, mock_secret_config):
+        self.assertEqual(get_property('data'), '/opt/app/data')
+        self.assertEqual(get_property('pct'), '100%')
+        self.assertEqual(get_property('data', section='app'), '/opt/app/data')
+
+    @mock.patch('dimple_utils.config_utils.os.getenv', return_value=None)
+    def test_load_properties_updates_config_map(self, mock_getenv):
         """
-        Test retrieving a secret from the secret_config.
+        Test config_map follows a reload and keys missing from the new files are dropped.
+        """
+        config_map = config_utils.config_map
+        with tempfile.TemporaryDirectory() as temp_dir:
+            default_file = os.path.join(temp_dir, 'default.properties')
+            with open(default_file, 'w') as f:
+                f.write("[DEFAULT]\nold_key = 1\nkept_key = 2\n")
+            load_properties(default_file=default_file)
+            self.assertEqual(config_map['DEFAULT:old_key'], '1')
+
+            with open(default_file, 'w') as f:
+                f.write("[DEFAULT]\nkept_key = 3\n")
+            load_properties(default_file=default_file)
+
+        self.assertNotIn('DEFAULT:old_key', config_map)
+        self.assertEqual(config_map['DEFAULT:kept_key'], '3')
+        self.assertIsNone(get_property('old_key'))
+        # The deprecated ConfigParser globals still follow the load
+        self.assertEqual(config_utils.config.get('DEFAULT', 'kept_key'), '3')
+        self.assertFalse(config_utils.config.has_option('DEFAULT', 'old_key'))
+        self.assertIsInstance(config_utils.secret_config, configparser.ConfigParser)
+
+    @mock.patch('dimple_utils.config_utils.os.getenv', return_value=None)
+    def test_print_properties_without_config(self, mock_getenv):
+        """
+        Test print_properties dumps the loaded configuration when no ConfigParser is given.
+        """
+        load_properties(default_file=TEST_DEFAULT_FILE)
+
+        with self.assertLogs('dimple_utils.config_utils', level='DEBUG') as logs, \
+                mock.patch('dimple_utils.config_utils.sys.stdout') as mock_stdout:
+            print_properties("Loaded")
+
+        output = mock_stdout.write.call_args.args[0]
+        self.assertIn("--- Loaded ---", output)
+        self.assertIn("  fetch_last_hours", output)
+        self.assertIn("fetch_last_hours", logs.output[0])
+
+    def test_parse_properties_file_matches_configparser(self):
+        """
+        Test that the fast parser reads the same values as ConfigParser.
         """
-        mock_secret_config.has_option.return_value = True
-        mock_secret_config.get.return_value = 'supersecret'
+        expected = configparser.ConfigParser()
+        expected.read(TEST_DEFAULT_FILE)
+        parsed = configparser.ConfigParser()
+        _read_properties_file(parsed, TEST_DEFAULT_FILE)
+
+        self.assertEqual(dict(parsed.defaults()), dict(expected.defaults()))
+        self.assertFalse(_read_properties_file(parsed, 'does_not_exist.properties'))
 
+    @mock.patch.dict('dimple_utils.config_utils._secret_map', {'SECRETS:api_key': 'supersecret'}, clear=True)
+    def test_get_secret(self):
+        """
+        Test retrieving a secret from the secret_config.
+        """
         # Test retrieval of secret
         secret_value = get_secret('API_KEY')
 
         self.assertEqual(secret_value, 'supersecret')
-        mock_secret_config.has_option.assert_called_once_with('SECRETS', 'API_KEY')
-        mock_secret_config.get.assert_called_once_with('SECRETS', 'API_KEY')
 
-    @mock.patch('dimple_utils.config_utils.secret_config')
-    def test_get_secret_missing(self, mock_secret_config):
+    @mock.patch.dict('dimple_utils.config_utils._secret_map', {}, clear=True)
+    def test_get_secret_missing(self):
         """
         Test retrieving a non-existent secret.
         """
-        mock_secret_config.has_option.return_value = False
-
         # Test that the secret is not found
         secret_value = get_secret('NON_EXISTENT_KEY')
 
         self.assertIsNone(secret_value)
-        mock_secret_config.has_option.assert_called_once_with('SECRETS', 'NON_EXISTENT_KEY')
+
+@mock.patch('dimple_utils.config_utils.os.getenv', return_value=None)
+class TestPropertiesParseCache(unittest.TestCase):
+
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.cache_dir = os.path.join(temp_dir.name, 'cache')
+        self.default_file = os.path.join(temp_dir.name, 'default.properties')
+        self._write("[DEFAULT]\nfetch_last_hours = 48\n")
+        patcher = mock.patch('dimple_utils.config_utils.CONFIG_CACHE_DIR', self.cache_dir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _write(self, content, mtime_ns=None):
+        with open(self.default_file, 'w') as f:
+            f.write(content)
+        if mtime_ns is not None:
+            os.utime(self.default_file, ns=(mtime_ns, mtime_ns))
+
+    def _load(self):
+        with mock.patch('dimple_utils.config_utils._parse_properties_file',
+                        wraps=config_utils._parse_properties_file) as mock_parse:
+            load_properties(default_file=self.default_file)
+        return mock_parse.call_count
+
+    def test_cache_hit(self, mock_getenv):
+        """
+        Test an unchanged file is parsed once and read from the cache afterwards.
+        """
+        self.assertEqual(self._load(), 1)
+        self.assertEqual(len(os.listdir(self.cache_dir)), 1)
+
+        self.assertEqual(self._load(), 0)
+        self.assertEqual(get_int_property('FETCH_LAST_HOURS'), 48)
+
+    def test_cache_invalidated_on_change(self, mock_getenv):
+        """
+        Test a file is parsed again when its modification time or size changes.
+        """
+        mtime_ns = os.stat(self.default_file).st_mtime_ns
+        self._load()
+
+        # Same size, new modification time
+        self._write("[DEFAULT]\nfetch_last_hours = 72\n", mtime_ns=mtime_ns + 10**9)
+        self.assertEqual(self._load(), 1)
+        self.assertEqual(get_int_property('FETCH_LAST_HOURS'), 72)
+
+        # Same modification time, new size
+        self._write("[DEFAULT]\nfetch_last_hours = 100\n", mtime_ns=mtime_ns + 10**9)
+        self.assertEqual(self._load(), 1)
+        self.assertEqual(get_int_property('FETCH_LAST_HOURS'), 100)
+
+    def test_cache_disabled(self, mock_getenv):
+        """
+        Test nothing is cached when CONFIG_CACHE_DIR isn't set.
+        """
+        with mock.patch('dimple_utils.config_utils.CONFIG_CACHE_DIR', None):
+            self.assertEqual(self._load(), 1)
+            self.assertEqual(self._load(), 1)
+
+        self.assertFalse(os.path.exists(self.cache_dir))
+
 
 if __name__ == '__main__':
     unittest.main()
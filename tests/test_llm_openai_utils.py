@@ -0,0 +1,231 @@
+import json
+import unittest
+from unittest import mock
+from dimple_utils import llm_openai_utils
+from dimple_utils.llm_openai_utils import infer_query, fetch_batch, CircuitOpenError, _retry_backoff
+
+
+def _completion(content):
+    return mock.Mock(choices=[mock.Mock(message=mock.Mock(content=content))])
+
+
+class TestLlmOpenaiUtils(unittest.TestCase):
+
+    def setUp(self):
+        """
+        Replace the OpenAI and shield clients with mocks and reset the module state before each test.
+        """
+        self.openai_client = mock.MagicMock()
+        self.openai_client.chat.completions.create.return_value = _completion('reply')
+        self.shield_client = mock.MagicMock()
+        # The shield passes the text through unchanged
+        self.shield_client.check_access.side_effect = \
+            lambda text, conversation_type, thread_id: [mock.Mock(response_text=text)]
+
+        patches = [
+            mock.patch.object(llm_openai_utils, 'openai_client', self.openai_client),
+            mock.patch.object(llm_openai_utils, 'privacera_shield_client', self.shield_client),
+            mock.patch.object(llm_openai_utils, '_initialized', True),
+            # Not in MODEL_CONTEXT_WINDOWS, so max_tokens isn't lowered and no tokens are counted
+            mock.patch.object(llm_openai_utils, 'openai_model', 'test-model'),
+            mock.patch.object(llm_openai_utils, 'max_retries', 3),
+            mock.patch.object(llm_openai_utils, 'retry_delay', 60),
+            mock.patch.object(llm_openai_utils, 'retry_delay_base', 4),
+            mock.patch.object(llm_openai_utils, 'circuit_failure_threshold', 3),
+            mock.patch.object(llm_openai_utils, 'circuit_cooldown', 60),
+            mock.patch.object(llm_openai_utils, '_circuit_failures', 0),
+            mock.patch.object(llm_openai_utils, '_circuit_open_until', 0.0),
+            mock.patch.object(llm_openai_utils, 'response_cache_enabled', False),
+            mock.patch('dimple_utils.llm_openai_utils.random.uniform', return_value=0),
+        ]
+        sleep_patcher = mock.patch('dimple_utils.llm_openai_utils.time.sleep')
+        self.mock_sleep = sleep_patcher.start()
+        self.addCleanup(sleep_patcher.stop)
+        for patcher in patches:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        llm_openai_utils.clear_response_cache()
+
+    def test_infer_query(self):
+        """
+        Test the prompt and the reply go through the shield and the system prompt is sent first.
+        """
+        reply = infer_query('prompt', 'user', system_prompt='instructions')
+
+        self.assertEqual(reply, 'reply')
+        messages = self.openai_client.chat.completions.create.call_args.kwargs['messages']
+        self.assertEqual(messages, [{"role": "system", "content": "instructions"},
+                                    {"role": "user", "content": "prompt"}])
+        self.assertEqual([call.kwargs['text'] for call in self.shield_client.check_access.call_args_list],
+                         ['prompt', 'reply'])
+
+    def test_retry_backoff(self):
+        """
+        Test the retry delay doubles from retry_delay_base up to retry_delay.
+        """
+        self.assertEqual([_retry_backoff(attempt) for attempt in range(6)], [4, 8, 16, 32, 60, 60])
+
+    def test_retry_backoff_jitter(self):
+        """
+        Test up to 10% of jitter is added to the retry delay.
+        """
+        with mock.patch('dimple_utils.llm_openai_utils.random.uniform', side_effect=lambda low, high: high):
+            self.assertAlmostEqual(_retry_backoff(1), 8.8)
+
+    def test_infer_query_retries(self):
+        """
+        Test rate limit errors are retried after the backoff delays and other errors are raised right away.
+        """
+        self.openai_client.chat.completions.create.side_effect = [
+            Exception("Rate limit reached for test-model"), Exception("Read timed out"), _completion('reply')]
+
+        self.assertEqual(infer_query('prompt', 'user'), 'reply')
+        self.assertEqual([call.args[0] for call in self.mock_sleep.call_args_list], [4, 8])
+
+        self.mock_sleep.reset_mock()
+        self.openai_client.chat.completions.create.side_effect = ValueError("bad request")
+        with self.assertRaises(ValueError):
+            infer_query('prompt', 'user')
+        self.mock_sleep.assert_not_called()
+
+    def test_infer_query_gives_up_after_max_retries(self):
+        """
+        Test infer_query fails after max_retries rate limited attempts.
+        """
+        self.openai_client.chat.completions.create.side_effect = Exception("Rate limit reached for test-model")
+
+        with self.assertRaises(Exception):
+            infer_query('prompt', 'user')
+        self.assertEqual(self.openai_client.chat.completions.create.call_count, 3)
+        self.assertEqual(self.mock_sleep.call_count, 2)
+
+    @mock.patch('dimple_utils.llm_openai_utils.time.monotonic')
+    def test_circuit_breaker(self, mock_monotonic):
+        """
+        Test the circuit opens after circuit_failure_threshold failures in a row, lets one probe through after the
+        cooldown and closes again when the probe succeeds.
+        """
+        mock_monotonic.return_value = 1000.0
+        create = self.openai_client.chat.completions.create
+        create.side_effect = Exception("Rate limit reached for test-model")
+        with self.assertRaises(Exception):
+            infer_query('prompt', 'user')
+        self.assertEqual(create.call_count, 3)
+
+        # Open, OpenAI isn't called
+        with self.assertRaises(CircuitOpenError):
+            infer_query('prompt', 'user')
+        self.assertEqual(create.call_count, 3)
+
+        # Half open after the cooldown, one call probes OpenAI while the others still fail fast
+        mock_monotonic.return_value = 1061.0
+        llm_openai_utils._circuit_before_call()
+        with self.assertRaises(CircuitOpenError):
+            llm_openai_utils._circuit_before_call()
+
+        # The probe succeeds and closes the circuit
+        create.side_effect = None
+        create.return_value = _completion('reply')
+        mock_monotonic.return_value = 1122.0
+        self.assertEqual(infer_query('prompt', 'user'), 'reply')
+        self.assertEqual(llm_openai_utils._circuit_failures, 0)
+        self.assertEqual(infer_query('prompt', 'user'), 'reply')
+
+    @mock.patch('dimple_utils.llm_openai_utils.time.monotonic', return_value=1000.0)
+    def test_circuit_breaker_failed_probe(self, mock_monotonic):
+        """
+        Test a failed probe opens the circuit again for another cooldown.
+        """
+        create = self.openai_client.chat.completions.create
+        create.side_effect = Exception("Rate limit reached for test-model")
+        with self.assertRaises(Exception):
+            infer_query('prompt', 'user')
+
+        mock_monotonic.return_value = 1061.0
+        with self.assertRaises(CircuitOpenError):
+            infer_query('prompt', 'user')
+        self.assertEqual(create.call_count, 4)
+        with self.assertRaises(CircuitOpenError):
+            infer_query('prompt', 'user')
+        self.assertEqual(create.call_count, 4)
+
+    def test_response_cache(self):
+        """
+        Test repeated prompts are answered from the cache, keyed by the user, the system prompt and the prompt.
+        """
+        create = self.openai_client.chat.completions.create
+        with mock.patch.object(llm_openai_utils, 'response_cache_enabled', True):
+            infer_query('prompt', 'user', system_prompt='instructions')
+            infer_query('prompt', 'user', system_prompt='instructions')
+            self.assertEqual(create.call_count, 1)
+            self.assertEqual(llm_openai_utils.response_cache_stats, {"hits": 1, "misses": 1})
+
+            infer_query('prompt', 'other_user', system_prompt='instructions')
+            infer_query('prompt', 'user', system_prompt='other instructions')
+            infer_query('prompt', 'user')
+            infer_query('other prompt', 'user', system_prompt='instructions')
+            self.assertEqual(create.call_count, 5)
+            self.assertEqual(llm_openai_utils.response_cache_stats, {"hits": 1, "misses": 5})
+
+    def test_response_cache_hit_checks_shield(self):
+        """
+        Test a cached reply still goes through the shield prompt and reply checks, only OpenAI isn't called.
+        """
+        with mock.patch.object(llm_openai_utils, 'response_cache_enabled', True):
+            infer_query('prompt', 'user')
+            self.shield_client.check_access.reset_mock()
+
+            self.assertEqual(infer_query('prompt', 'user'), 'reply')
+
+        self.assertEqual(self.openai_client.chat.completions.create.call_count, 1)
+        self.assertEqual([call.kwargs['text'] for call in self.shield_client.check_access.call_args_list],
+                         ['prompt', 'reply'])
+        self.assertEqual(llm_openai_utils.response_cache_stats, {"hits": 1, "misses": 1})
+
+    def test_response_cache_disabled(self):
+        """
+        Test nothing is cached when the cache is disabled.
+        """
+        infer_query('prompt', 'user')
+        infer_query('prompt', 'user')
+
+        self.assertEqual(self.openai_client.chat.completions.create.call_count, 2)
+        self.assertEqual(llm_openai_utils.response_cache_stats, {"hits": 0, "misses": 0})
+
+    def test_fetch_batch(self):
+        """
+        Test the replies are returned in prompt order whatever the order of the output file, with None for the failed
+        requests.
+        """
+        self.openai_client.batches.retrieve.side_effect = [
+            mock.Mock(status="in_progress"),
+            mock.Mock(status="completed", output_file_id="file-1", request_counts=mock.Mock(total=3)),
+        ]
+        results = [
+            {"custom_id": "2:thread-2", "response": {"status_code": 200,
+                                                     "body": {"choices": [{"message": {"content": "reply 2"}}]}}},
+            {"custom_id": "1:thread-1", "response": {"status_code": 500, "body": {}}, "error": "server error"},
+            {"custom_id": "0:thread-0", "response": {"status_code": 200,
+                                                     "body": {"choices": [{"message": {"content": "reply 0"}}]}}},
+        ]
+        self.openai_client.files.content.return_value.text = "\n".join(json.dumps(result) for result in results)
+
+        replies = fetch_batch('batch-1', 'user', poll_interval=5)
+
+        self.assertEqual(replies, ['reply 0', None, 'reply 2'])
+        self.mock_sleep.assert_called_once_with(5)
+        self.assertEqual([call.kwargs['thread_id'] for call in self.shield_client.check_access.call_args_list],
+                         ['thread-2', 'thread-0'])
+
+    def test_fetch_batch_failed(self):
+        """
+        Test a batch that didn't complete raises an error.
+        """
+        self.openai_client.batches.retrieve.return_value = mock.Mock(status="expired")
+
+        with self.assertRaises(Exception):
+            fetch_batch('batch-1', 'user')
+
+
+if __name__ == '__main__':
+    unittest.main()